@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from flask import Flask
-from peewee import MySQLDatabase
 from celery import Celery
 
 from config import config
+from utils.db_util import MonitoredPooledMySQLDatabase
 
 
-db = MySQLDatabase(None)
+db = MonitoredPooledMySQLDatabase(None)
 
 
 def create_app(config_name):
@@ -19,10 +19,7 @@ def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
-    db.init(**app.config['MYSQL'])
-
-    from .models import models
-    db.create_tables(models, safe=True)
+    db.init(**app.config['MYSQL'])  # 表结构由migrate.py维护，启动时不执行DDL
 
     from .hooks import before_app_request, after_app_request
     app.before_request(before_app_request)
@@ -3,6 +3,7 @@
 from flask import request, g
 
 from .api_utils import *
+from .constants import DEFAULT_PER_PAGE, MAX_OFFSET_ROWS
 
 
 __all__ = [
@@ -10,25 +11,56 @@ __all__ = [
     'get_object',
     'update_object_show',
     'update_object_weight',
+    'update_objects',
     'delete_object',
     'delete_objects'
 ]
 
 
+def _count_objects(model, total='exact'):
+    """
+    对象总数
+    :param model:
+    :param total: 'exact', 'estimate', 'none'
+    :return:
+    """
+    if total == 'estimate':
+        return model.estimated_count()
+    if total == 'exact':
+        return model.count()
+
+
 def list_objects(model, mark='objects'):
     """
     列出全部对象
+    URL参数包含after或before时使用游标分页（值为空时返回第一页），否则使用page/per_page分页且只允许浅分页；
+    URL参数total: 'exact' - 精确总数（默认，有缓存），'estimate' - 根据表统计信息估算，'none' - 不返回总数
     :param model:
     :param mark:
     :return:
     """
-    order_by, page, per_page = map(request.args.get, ('order_by', 'page', 'per_page'))
+    order_by, page, per_page, after, before = map(request.args.get, ('order_by', 'page', 'per_page', 'after', 'before'))
     order_by = order_by.split(',') if order_by else None
     claim_args_digits_string(1202, *filter(None, (page, per_page)))
-
+    total = request.args.get('total') or 'exact'
+    claim_args_true(1202, total in ['exact', 'estimate', 'none'])
+
+    if after is not None or before is not None:
+        result = model.cursor_page(None, order_by, after, before, per_page, g.fields)
+        claim_args_true(1202, result)
+        objects, prev_cursor, next_cursor = result
+        data = {
+            mark: model.to_dicts(objects, g.fields),
+            'total': _count_objects(model, total),
+            'prev': prev_cursor,
+            'next': next_cursor
+        }
+        return api_success_response(data)
+
+    claim_args_true(1202, int(page or 1) * int(per_page or DEFAULT_PER_PAGE) <= MAX_OFFSET_ROWS)
     data = {
-        mark: [obj.to_dict(g.fields) for obj in model.iterator(None, order_by, page, per_page)],
-        'total': model.count()
+        mark: model.to_dicts(model.iterator(None, order_by, page, per_page, True, g.fields), g.fields),
+        'total': _count_objects(model, total)
     }
     return api_success_response(data)
 
@@ -42,7 +74,7 @@ def get_object(model, _id=None, _uuid=None, mark='object'):
     :param mark:
     :return:
     """
-    obj = model.query_by_id(_id) or model.query_by_uuid(_uuid)
+    obj = model.query_by_id(_id, g.fields) or model.query_by_uuid(_uuid, g.fields)
     claim_args(1104, obj)
 
     data = {
@@ -93,6 +125,39 @@ def update_object_weight(model, _id=None, _uuid=None, mark='object'):
     return api_success_response(data)
 
 
+def update_objects(model, mark='objects'):
+    """
+    批量修改对象是否展示/排序权重
+    json数据: {'objects': [{'id' or 'uuid': ..., 'show': [bool, 可选], 'weight': [int, 可选]}]}
+    :param model:
+    :param mark:
+    :return:
+    """
+    items = g.json.get('objects')
+    claim_args(1401, items)
+    claim_args_list(1402, items)
+    claim_args_dict(1402, *items)
+    for item in items:
+        _id, _uuid = map(item.get, ('id', 'uuid'))
+        claim_args_true(1401, _id is not None or _uuid, 'show' in item or 'weight' in item)
+        if _id is not None:
+            claim_args_int(1402, _id)
+        else:
+            claim_args_string(1402, _uuid)
+        if 'show' in item:
+            claim_args_bool(1402, item['show'])
+        if 'weight' in item:
+            claim_args_int(1402, item['weight'])
+
+    objects = model.bulk_set_show_weight(items)
+    claim_args(1104, objects)
+
+    data = {
+        mark: model.to_dicts(objects, g.fields)
+    }
+    return api_success_response(data)
+
+
 def delete_object(model, _id=None, _uuid=None):
     """
     删除单个对象
@@ -110,7 +175,7 @@ def delete_object(model, _id=None, _uuid=None):
 
 def delete_objects(model):
     """
-    删除多个对象
+    删除多个对象（一次查询确定存在的对象，在同一事务中集合式级联删除）
     :param model:
     :return:
     """
@@ -119,12 +184,12 @@ def delete_objects(model):
     if ids:
         ids = ids.split(',')
         claim_args_digits_string(1602, *ids)
-        objects = map(model.query_by_id, ids)
+        deleted, missing = model.bulk_delete(ids=ids)
     else:
-        uuids = uuids.split(',')
-        objects = map(model.query_by_uuid, uuids)
-    claim_args(1104, *objects)
+        deleted, missing = model.bulk_delete(uuids=uuids.split(','))
 
-    for obj in objects:
-        obj.delete_instance(recursive=True)
-    return api_success_response({})
+    data = {
+        'deleted': deleted,
+        'missing': missing
+    }
+    return api_success_response(data)
@@ -55,6 +55,17 @@ def update_current_admin_password():
 
     g.admin.change_password(password_new)
     data = {
+        'token': g.admin.generate_token(),  # 修改密码后之前签发的令牌全部失效
         'admin': g.admin.to_dict(g.fields)
     }
     return api_success_response(data)
+
+
+@bp_cms_api.route('/current_admin/logout/', methods=['PUT'])
+def logout():
+    """
+    管理员退出登录（已签发的身份令牌全部失效）
+    :return:
+    """
+    g.admin.revoke_tokens()
+    return api_success_response({})
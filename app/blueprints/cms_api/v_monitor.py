@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from . import bp_cms_api
+from ... import db
+from ...api_utils import *
+
+
+@bp_cms_api.route('/monitor/db_pool/', methods=['GET'])
+def get_db_pool_stats():
+    """
+    获取当前进程的数据库连接池统计信息
+    :return:
+    """
+    data = {
+        'db_pool': db.stats()
+    }
+    return api_success_response(data)
@@ -1,18 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import urllib
-import time
 
 from flask import current_app, request, url_for, redirect, make_response, jsonify
 import requests
 
 from . import bp_open_main
-from ...models import WXAuthorizer, WXUser
-from ...services.weixin import WXMsgCrypto
+from ...models import WXAuthorizer
+from ...services.weixin import WXMsgCrypto, reply_text
 from ...constants import AUTHORIZERS_FOR_RELEASE_TESTING
 from utils.qiniu_util import get_upload_token
 from utils.redis_util import redis_client
-from utils.weixin_util import get_pre_auth_code, get_authorization_info
+from utils.weixin_util import set_token, get_pre_auth_code, get_authorization_info, message_dedup_key, claim_message, \
+    finish_message, release_message
 
 
 @bp_open_main.route('/extensions/qn/upload_token/', methods=['GET'])
@@ -52,7 +52,7 @@ def wx_component_api():
     if request.method == 'POST':
         try:
             wx = current_app.config['WEIXIN']
-            crypto = WXMsgCrypto(wx)
+            crypto = WXMsgCrypto.from_config(wx)
             message = crypto.decrypt(request.data, msg_signature, timestamp, nonce)
             current_app.logger.info(message)
             assert message['AppId'] == wx['app_id'], u'微信AppId验证失败'
@@ -114,15 +114,18 @@ def wx_authorizer_login():
             ('authorizer_appid', 'authorizer_refresh_token', 'func_info', 'authorizer_access_token', 'expires_in')
         )
         assert all((appid, refresh_token, func_info, access_token, expires_in)), u'微信公众号/小程序授权：授权信息不完整'
-        wx_authorizer = WXAuthorizer.query_by_appid(appid)
+        wx_authorizer, created = WXAuthorizer.query_by_appid(appid), False
         if wx_authorizer:
             wx_authorizer.update_refresh_token(refresh_token)
             wx_authorizer.update_func_info(func_info)
         else:
             wx_authorizer = WXAuthorizer.create_wx_authorizer(appid, refresh_token, func_info)
+            created = True
         assert wx_authorizer.update_authorizer_info(), u'微信公众号/小程序授权：基本信息获取失败'
-        key = 'wx_authorizer:%s:access_token' % appid
-        redis_client.set(key, access_token, ex=int(expires_in) - 600)  # 提前10分钟更新access_token
+        set_token('wx_authorizer:%s:access_token' % appid, access_token, expires_in)
+        if created and not wx_authorizer.mini_program_info:
+            from ...tasks import sync_wx_followers
+            sync_wx_followers.delay(wx_authorizer.id)  # celery task：同步授权前已有的关注者
         resp = redirect(wx['auth_success_page'])
     except Exception, e:
         current_app.logger.error(e)
@@ -155,39 +158,34 @@ def wx_authorizer_api(appid):
         return make_response(request.args.get('echostr', ''))
 
     if request.method == 'POST':
+        dedup_key, failed = None, False
         try:
-            wx_authorizer = WXAuthorizer.query_by_appid(appid)
-            assert wx_authorizer, u'微信授权方查询失败'
             wx = current_app.config['WEIXIN']
-            crypto = WXMsgCrypto(wx)
+            crypto = WXMsgCrypto.from_config(wx)
             message = crypto.decrypt(request.data, msg_signature, timestamp, nonce)
             current_app.logger.info(message)
+
+            # 微信重试的消息：直接返回已保存的被动回复或success
+            key = message_dedup_key(appid, message)
+            claimed, reply = claim_message(key)
+            if not claimed:
+                resp = reply or resp
+                return
+            dedup_key = key
+
+            wx_authorizer = WXAuthorizer.query_by_appid(appid)
+            assert wx_authorizer, u'微信授权方查询失败'
             openid, msg_type, event = map(message.get, ('FromUserName', 'MsgType', 'Event'))
 
             # 全网发布专用测试公众号/小程序
             if appid in AUTHORIZERS_FOR_RELEASE_TESTING:
                 if msg_type == 'event':
-                    template = 'weixin/reply_text_msg.xml'
-                    params = {
-                        'to_user': openid,
-                        'from_user': message['ToUserName'],
-                        'time': int(time.time()),
-                        'content': event + 'from_callback'
-                    }
-                    msg = current_app.jinja_env.get_template(template).render(**params)
-                    resp = crypto.encrypt(msg.encode('utf-8'))
+                    resp = crypto.encrypt(reply_text(openid, message['ToUserName'], event + 'from_callback'))
                 elif msg_type == 'text':
                     content = message['Content']
                     if content == 'TESTCOMPONENT_MSG_TYPE_TEXT':
-                        template = 'weixin/reply_text_msg.xml'
-                        params = {
-                            'to_user': openid,
-                            'from_user': message['ToUserName'],
-                            'time': int(time.time()),
-                            'content': 'TESTCOMPONENT_MSG_TYPE_TEXT_callback'
-                        }
-                        msg = current_app.jinja_env.get_template(template).render(**params)
-                        resp = crypto.encrypt(msg.encode('utf-8'))
+                        msg = reply_text(openid, message['ToUserName'], 'TESTCOMPONENT_MSG_TYPE_TEXT_callback')
+                        resp = crypto.encrypt(msg)
                     elif content.startswith('QUERY_AUTH_CODE:'):
                         from ...tasks import for_release_testing
                         for_release_testing.delay(wx_authorizer, openid, content.split(':', 1)[-1])  # celery task
@@ -197,28 +195,21 @@ def wx_authorizer_api(appid):
             if msg_type == 'event' and event in ['TEMPLATESENDJOBFINISH', 'MASSSENDJOBFINISH']:
                 return
 
-            # 用户取消关注的事件推送
-            wx_user = WXUser.query_by_openid(wx_authorizer, openid)
-            if not wx_user and msg_type == 'event' and event == 'unsubscribe':
-                return
-
-            # 获取微信用户基本信息
-            key = 'wx_user:%s:%s:info' % (wx_authorizer.id, openid)
-            if not wx_user or (msg_type == 'event' and event in ['subscribe', 'unsubscribe']):
-                redis_client.delete(key)
-            if redis_client.get(key) != 'off':
-                redis_client.set(key, 'off', ex=86400)  # 每隔一天更新微信用户基本信息
-                info = wx_authorizer.get_user_info(openid)
-                if info:
-                    if wx_user:
-                        wx_user.update_wx_user(**info)
-                    else:
-                        wx_user = WXUser.create_wx_user(wx_authorizer, **info)
-                else:
-                    current_app.logger.error(u'微信用户基本信息获取失败')
+            # 获取微信用户基本信息（异步，是否为已知用户由任务判断，回调中不查询数据库）
+            from ...tasks import enqueue_wx_user_sync
+            enqueue_wx_user_sync(wx_authorizer.id, openid,
+                                 force=msg_type == 'event' and event in ['subscribe', 'unsubscribe'])
 
             # TODO: 微信公众号/小程序API业务逻辑
         except Exception, e:
+            failed = True
             current_app.logger.error(e)
         finally:
+            try:
+                if failed:
+                    release_message(dedup_key)  # 处理失败时允许微信重试
+                else:
+                    finish_message(dedup_key, None if resp == 'success' else resp)
+            except Exception, e:
+                current_app.logger.error(e)
             return make_response(resp)
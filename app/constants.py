@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
 DEFAULT_PER_PAGE = 20
+COUNT_CACHE_TTL = 3600  # 计数缓存的有效期（秒）
+FILTERED_COUNT_CACHE_TTL = 60  # 带条件的计数缓存的有效期（秒），期间数据更新不会使其失效
+MAX_OFFSET_ROWS = 2000  # page/per_page分页允许的最大行数，更深的分页使用游标分页
 
 ADMIN_TOKEN_TAG = 'admin'
 ADMIN_TOKEN_VALID_DAYS = 7
+ADMIN_TOKEN_CACHE_TTL = 300  # 管理员身份令牌验证结果的缓存时间（秒）
 
 MIN_PASSWORD_LEN = 6
 
 WX_USER_COOKIE_KEY = 'wx_user'
 WX_USER_COOKIE_VALID_DAYS = 30
+WX_USER_SESSION_TTL = 300  # 微信用户会话缓存时间（秒）
+WX_USER_INFO_BATCH_SIZE = 100  # 批量获取微信用户基本信息时每次请求的最大用户数
+WX_USER_SYNC_WINDOW = 2  # 微信用户基本信息同步的合并窗口（秒）
+WX_AUTHORIZER_CACHE_TTL = 600  # 微信授权方数据行在redis中的缓存时间（秒）
+WX_FOLLOWER_SYNC_MAX_RETRIES = 10  # 关注者同步一页失败后的最大重试次数
+WX_FOLLOWER_SYNC_RETRY_DELAY = 60  # 关注者同步首次重试的等待时间（秒），之后指数退避
 
 AUTHORIZERS_FOR_RELEASE_TESTING = ['wx570bc396a51b8ff8', 'wxd101a85aa106f53e']
@@ -7,22 +7,21 @@ from . import db
 
 def before_app_request():
     """
-    请求前全局钩子函数
+    请求前全局钩子函数（数据库连接在首次查询时才从连接池取出）
     :return:
     """
     if not (request.blueprint and request.endpoint):
         abort(404)
 
     g.ip = request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')  # g.ip
-    if db.is_closed():
-        db.connect()
 
 
 def after_app_request(resp):
     """
-    请求后全局钩子函数
+    请求后全局钩子函数：清空请求内对象映射，将数据库连接放回连接池
     :param resp:
     :return:
     """
+    g.pop('identity_map', None)
     if not db.is_closed():
         db.close()
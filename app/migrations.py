@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import ast
+import json
+
+from peewee import *
+from playhouse.migrate import MySQLMigrator, migrate
+
+from . import db
+
+
+MIGRATIONS = []  # [(版本号, 说明, 迁移函数)]
+
+
+class SchemaMigration(Model):
+    """
+    已执行的数据库迁移
+    """
+    version = IntegerField(primary_key=True)  # 版本号
+    description = CharField()  # 说明
+    apply_time = DateTimeField(default=datetime.datetime.now)  # 执行时间
+
+    class Meta:
+        database = db
+        db_table = 'schema_migration'
+
+
+def migration(version, description):
+    """
+    注册数据库迁移（版本号递增，已发布的迁移不可修改）
+    :param version: [int]
+    :param description:
+    :return:
+    """
+    def decorator(f):
+        MIGRATIONS.append((version, description, f))
+        return f
+
+    return decorator
+
+
+_INITIAL_SCHEMA = [  # 版本1的表结构（固定为当时的DDL，不随model变化）
+    """CREATE TABLE IF NOT EXISTS `admin` (
+        `id` INTEGER AUTO_INCREMENT NOT NULL PRIMARY KEY,
+        `uuid` VARCHAR(40) NOT NULL,
+        `create_time` DATETIME NOT NULL,
+        `update_time` DATETIME NOT NULL,
+        `show` BOOL NOT NULL,
+        `weight` INTEGER NOT NULL,
+        `name` VARCHAR(32) NOT NULL,
+        `password` VARCHAR(255) NOT NULL,
+        `mobile` VARCHAR(255),
+        `last_login_time` DATETIME,
+        `last_login_ip` VARCHAR(255),
+        `authority` BIGINT NOT NULL,
+        UNIQUE INDEX `admin_uuid` (`uuid`),
+        UNIQUE INDEX `admin_name` (`name`)
+    )""",
+    """CREATE TABLE IF NOT EXISTS `wx_authorizer` (
+        `id` INTEGER AUTO_INCREMENT NOT NULL PRIMARY KEY,
+        `uuid` VARCHAR(40) NOT NULL,
+        `create_time` DATETIME NOT NULL,
+        `update_time` DATETIME NOT NULL,
+        `show` BOOL NOT NULL,
+        `weight` INTEGER NOT NULL,
+        `authorized` BOOL NOT NULL,
+        `appid` VARCHAR(40) NOT NULL,
+        `refresh_token` VARCHAR(255) NOT NULL,
+        `func_info` LONGTEXT NOT NULL,
+        `authorizer_info` LONGTEXT,
+        `service_type` INTEGER,
+        `verify_type` INTEGER,
+        `nick_name` VARCHAR(255),
+        `signature` VARCHAR(255),
+        `head_img` VARCHAR(255),
+        `qrcode_url` VARCHAR(255),
+        `principal_name` VARCHAR(255),
+        `user_name` VARCHAR(255),
+        `alias` VARCHAR(255),
+        `business_info` LONGTEXT,
+        `mini_program_info` LONGTEXT,
+        UNIQUE INDEX `wx_authorizer_uuid` (`uuid`),
+        UNIQUE INDEX `wx_authorizer_appid` (`appid`)
+    )""",
+    """CREATE TABLE IF NOT EXISTS `wx_user` (
+        `id` INTEGER AUTO_INCREMENT NOT NULL PRIMARY KEY,
+        `uuid` VARCHAR(40) NOT NULL,
+        `create_time` DATETIME NOT NULL,
+        `update_time` DATETIME NOT NULL,
+        `show` BOOL NOT NULL,
+        `weight` INTEGER NOT NULL,
+        `wx_authorizer_id` INTEGER NOT NULL,
+        `openid` VARCHAR(40) NOT NULL,
+        `unionid` VARCHAR(255),
+        `nickname` VARCHAR(255),
+        `sex` INTEGER,
+        `country` VARCHAR(255),
+        `province` VARCHAR(255),
+        `city` VARCHAR(255),
+        `headimgurl` VARCHAR(255),
+        `subscribe` INTEGER,
+        `subscribe_time` INTEGER,
+        `language` VARCHAR(255),
+        `remark` VARCHAR(255),
+        `tagid_list` LONGTEXT,
+        UNIQUE INDEX `wx_user_uuid` (`uuid`),
+        INDEX `wx_user_wx_authorizer_id` (`wx_authorizer_id`),
+        INDEX `wx_user_openid` (`openid`),
+        FOREIGN KEY (`wx_authorizer_id`) REFERENCES `wx_authorizer` (`id`) ON DELETE CASCADE
+    )"""
+]
+
+
+@migration(1, u'创建admin、wx_authorizer、wx_user表')
+def create_initial_tables(migrator):
+    for sql in _INITIAL_SCHEMA:
+        db.execute_sql(sql)
+
+
+def applied_versions():
+    """
+    已执行的迁移版本号
+    :return:
+    """
+    SchemaMigration.create_table(fail_silently=True)
+    return {version for version, in SchemaMigration.select(SchemaMigration.version).tuples()}
+
+
+def upgrade(target=None):
+    """
+    按版本号顺序执行未执行的迁移（通过MySQL命名锁避免多个进程同时执行）
+    :param target: 执行到该版本号为止，为None时执行全部
+    :return: 本次执行的版本号列表
+    """
+    assert db.execute_sql("SELECT GET_LOCK('schema_migration', 60)").fetchone()[0] == 1, u'数据库迁移锁获取失败'
+    try:
+        applied, done = applied_versions(), []
+        migrator = MySQLMigrator(db)
+        for version, description, f in sorted(MIGRATIONS):
+            if version in applied or (target is not None and version > target):
+                continue
+            f(migrator)
+            SchemaMigration.create(version=version, description=description)
+            done.append(version)
+        return done
+    finally:
+        db.execute_sql("SELECT RELEASE_LOCK('schema_migration')")
+
+
+@migration(2, u'wx_authorizer的func_info、authorizer_info、business_info、mini_program_info由repr()改为JSON')
+def convert_wx_authorizer_info_to_json(migrator):
+    columns = ('func_info', 'authorizer_info', 'business_info', 'mini_program_info')
+    last_id = 0
+    while True:
+        rows = db.execute_sql('SELECT id, %s FROM wx_authorizer WHERE id > %%s ORDER BY id LIMIT 100'
+                              % ', '.join(columns), (last_id,)).fetchall()
+        if not rows:
+            break
+
+        with db.atomic():
+            for row in rows:
+                values = []
+                for value in row[1:]:
+                    if value is not None:
+                        try:
+                            json.loads(value)
+                        except ValueError:
+                            value = json.dumps(ast.literal_eval(value), ensure_ascii=False)
+                    values.append(value)
+                db.execute_sql('UPDATE wx_authorizer SET %s WHERE id = %%s' % ', '.join('%s = %%s' % c for c in columns),
+                               values + [row[0]])
+        last_id = rows[-1][0]
+
+
+@migration(3, u'admin增加token_version（身份令牌版本号）')
+def add_admin_token_version(migrator):
+    migrate(migrator.add_column('admin', 'token_version', IntegerField(default=0)))
+
+
+@migration(4, u'wx_user增加唯一索引(wx_authorizer_id, openid)，先删除重复的用户（保留id最小的）')
+def add_wx_user_openid_unique_index(migrator):
+    db.execute_sql(
+        'DELETE u FROM wx_user u JOIN ('
+        'SELECT wx_authorizer_id, openid, MIN(id) AS keep_id FROM wx_user '
+        'GROUP BY wx_authorizer_id, openid HAVING COUNT(*) > 1'
+        ') d ON u.wx_authorizer_id = d.wx_authorizer_id AND u.openid = d.openid AND u.id <> d.keep_id'
+    )
+    migrate(migrator.add_index('wx_user', ('wx_authorizer_id', 'openid'), True))
@@ -1,27 +1,72 @@
 # -*- coding: utf-8 -*-
 
-from uuid import uuid1
+from uuid import uuid1, UUID
 import datetime
 import time
 import json
+import base64
 import hashlib
+import operator
 
-from flask import current_app
+from flask import current_app, g, has_request_context
 from peewee import *
+from peewee import Case
 from playhouse.shortcuts import model_to_dict
 from werkzeug.security import generate_password_hash, check_password_hash
-import requests
 
+from .fields import JSONField, RawJSON, MappedForeignKeyField
 from .. import db
-from ..constants import DEFAULT_PER_PAGE, ADMIN_TOKEN_TAG, ADMIN_TOKEN_VALID_DAYS
+from ..constants import DEFAULT_PER_PAGE, COUNT_CACHE_TTL, FILTERED_COUNT_CACHE_TTL, ADMIN_TOKEN_TAG, \
+    ADMIN_TOKEN_VALID_DAYS, ADMIN_TOKEN_CACHE_TTL, WX_USER_INFO_BATCH_SIZE, WX_AUTHORIZER_CACHE_TTL, \
+    WX_USER_SESSION_TTL
 from utils.aes_util import encrypt, decrypt
+from utils.http_util import http_client
 from utils.key_util import generate_random_key
-from utils.redis_util import redis_client
-from utils.weixin_util import VERIFY, get_component_access_token
+from utils.redis_util import redis_client, cached_get, invalidate, single_flight, refresh_ahead, \
+    dumps_signed, loads_signed, set_indexed, delete_indexed, CACHE_SIGNING_KEY
+from utils.weixin_util import VERIFY, TOKEN_REFRESH_AHEAD, TICKET_IN_USE_TTL, set_token, get_component_access_token
 
 
 _to_set = (lambda r: set(r) if r else set())
+_incr_if_exists = redis_client.register_script(
+    "if redis.call('exists', KEYS[1]) == 1 then return redis.call('incrby', KEYS[1], ARGV[1]) end"
+)
 _nullable_strip = (lambda s: s.strip() or None if s else None)
+_serializer_plans = {}  # (model, only, exclude) -> 字段提取计划
+_CASCADE_BATCH_SIZE = 1000  # 逐层级联删除时每批处理的依赖数据行数
+_tickets_in_use = {}  # ticket的缓存key -> 本进程最近一次标记为使用中的时间
+
+
+def _identity_map():
+    """
+    当前请求内的对象映射：(model, 查询字段, 值) -> 对象，同一请求中同一行只查询一次；不在请求上下文中时返回None
+    :return:
+    """
+    if not has_request_context():
+        return
+    identity_map = getattr(g, 'identity_map', None)
+    if identity_map is None:
+        identity_map = g.identity_map = {}
+    return identity_map
+
+
+class _Row(object):
+    """
+    以属性方式访问dict数据行，用于不创建对象时计算额外属性
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getattr__(self, name):
+        try:
+            value = self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+        if isinstance(value, RawJSON):
+            value = self._data[name] = value.load()
+        return value
 
 
 class BaseModel(Model):
@@ -56,83 +101,517 @@ class BaseModel(Model):
         return {'iso_create_time', 'iso_update_time'}
 
     @classmethod
-    def query_by_id(cls, _id):
+    def _projection(cls, fields=None, ordering=None):
+        """
+        根据需要返回的字段确定需要查询的列：额外属性映射到来源字段（如iso_create_time -> create_time），总是包含id
+        :param fields: [iterable or None]
+        :param ordering: [(field, desc)] 排序字段
+        :return: [list or None] 为None时查询全部列
+        """
+        if not fields:
+            return
+
+        _fields = cls._meta.fields
+        exclude, extra_attrs = cls._exclude_fields(), cls._extra_attributes()
+        names = {'id'} | {f.name for f, desc in ordering or []}
+        for name in fields:
+            if name in extra_attrs:
+                name = name.split('_', 1)[-1]
+            elif name in exclude:
+                continue
+            if name in _fields:
+                names.add(name)
+        return [f for f in cls._meta.sorted_fields if f.name in names]
+
+    @classmethod
+    def _select(cls, fields=None, ordering=None):
+        """
+        只查询需要的列
+        :param fields: [iterable or None]
+        :param ordering: [(field, desc)]
+        :return:
+        """
+        return cls.select(*(cls._projection(fields, ordering) or []))
+
+    @classmethod
+    def _identity_keys(cls, obj):
+        """
+        对象在请求内对象映射中的键
+        :param obj:
+        :return:
         """
-        根据id查询
+        return [('id', obj.id), ('uuid', str(obj.uuid))]
+
+    @classmethod
+    def _mapped(cls, name, value):
+        """
+        从请求内对象映射中查找
+        :param name: 查询字段
+        :param value:
+        :return:
+        """
+        identity_map = _identity_map()
+        if identity_map is not None:
+            return identity_map.get((cls, name, value))
+
+    @classmethod
+    def _map(cls, obj):
+        """
+        将查询出的完整对象加入请求内对象映射
+        :param obj:
+        :return:
+        """
+        identity_map = _identity_map()
+        if identity_map is not None and obj is not None:
+            for name, value in cls._identity_keys(obj):
+                identity_map[(cls, name, value)] = obj
+        return obj
+
+    @classmethod
+    def _unmap(cls, obj=None):
+        """
+        从请求内对象映射中移除对象
+        :param obj: 为None时移除该model的全部对象
+        :return:
+        """
+        identity_map = _identity_map()
+        if identity_map:
+            for key in [k for k, v in identity_map.iteritems() if k[0] is cls and (obj is None or v is obj)]:
+                del identity_map[key]
+
+    @classmethod
+    def _from_data(cls, data):
+        """
+        由缓存的数据行恢复对象（视为与数据库一致）
+        :param data: [dict]
+        :return:
+        """
+        obj = cls()
+        obj._data = data
+        obj._dirty.clear()
+        obj.prepared()
+        return obj
+
+    @classmethod
+    def query_by_id(cls, _id, fields=None):
+        """
+        根据id查询（不指定fields时使用请求内对象映射）
         :param _id:
+        :param fields: [iterable or None] 只查询这些字段（及额外属性）需要的列
         :return:
         """
         obj = None
         try:
-            obj = cls.get(cls.id == _id)
+            if fields:
+                obj = cls._select(fields).where(cls.id == _id).get()
+            else:
+                obj = cls._mapped('id', int(_id)) or cls._map(cls.get(cls.id == _id))
         finally:
             return obj
 
     @classmethod
-    def query_by_uuid(cls, _uuid):
+    def query_by_uuid(cls, _uuid, fields=None):
         """
-        根据uuid查询
+        根据uuid查询（不指定fields时使用请求内对象映射）
         :param _uuid:
+        :param fields: [iterable or None] 只查询这些字段（及额外属性）需要的列
         :return:
         """
         obj = None
         try:
-            obj = cls.get(cls.uuid == _uuid)
+            if fields:
+                obj = cls._select(fields).where(cls.uuid == _uuid).get()
+            else:
+                obj = cls._mapped('uuid', str(UUID(str(_uuid)))) or cls._map(cls.get(cls.uuid == _uuid))
         finally:
             return obj
 
     @classmethod
-    def count(cls, select_query=None):
+    def count(cls, select_query=None, cached=None):
         """
         根据查询条件计数
+        不带条件的计数缓存在redis中，由创建/删除增减；带条件的计数只在cached=True时按SQL缓存，
+        创建/删除时整体失效，其他修改在FILTERED_COUNT_CACHE_TTL秒内可能不反映
         :param select_query: [SelectQuery or None]
+        :param cached: [bool or None] 是否使用缓存，为None时只缓存不带条件的计数
         :return:
         """
         cnt = 0
         try:
+            table = cls._meta.db_table
             if select_query is None:
                 select_query = cls.select()
+                key, field = 'count:%s' % table, None
+            else:
+                sql, params = select_query.sql()
+                key, field = 'count:%s:filtered' % table, hashlib.md5(repr((sql, params))).hexdigest()
+            if cached is None:
+                cached = field is None
+
+            if cached:
+                value = redis_client.get(key) if field is None else redis_client.hget(key, field)
+                if value is not None:
+                    if field is None:
+                        return int(value)
+                    value, timestamp = map(int, value.split(':'))
+                    if time.time() - timestamp < FILTERED_COUNT_CACHE_TTL:
+                        return value
+
             cnt = select_query.count()
+            if cached:
+                if field is None:
+                    redis_client.set(key, cnt, ex=COUNT_CACHE_TTL)
+                else:
+                    pipe = redis_client.pipeline()
+                    pipe.hset(key, field, '%d:%d' % (cnt, time.time()))
+                    pipe.expire(key, COUNT_CACHE_TTL)
+                    pipe.execute()
         finally:
             return cnt
 
     @classmethod
-    def iterator(cls, select_query=None, order_by=None, page=None, per_page=None):
+    def count_changed(cls, delta=None):
+        """
+        创建/删除数据后更新计数缓存：在事务中时等到提交后再更新，事务回滚时不更新
+        :param delta: [int or None] 数据行数的变化量，为None时使不带条件的计数也失效
+        :return:
+        """
+        def _changed():
+            try:
+                table = cls._meta.db_table
+                if delta is None:
+                    redis_client.delete('count:%s' % table, 'count:%s:filtered' % table)
+                else:
+                    _incr_if_exists(keys=['count:%s' % table], args=[delta])
+                    redis_client.delete('count:%s:filtered' % table)
+
+            except Exception, e:
+                current_app.logger.error(e)
+
+        db.on_commit(_changed)
+
+    @classmethod
+    def estimated_count(cls):
+        """
+        根据表统计信息估算行数（InnoDB的估算值可能有较大误差）
+        :return:
+        """
+        cnt = 0
+        try:
+            cursor = db.execute_sql(
+                'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                (cls._meta.db_table,)
+            )
+            row = cursor.fetchone()
+            cnt = int(row[0] or 0) if row else 0
+        finally:
+            return cnt
+
+    def save(self, force_insert=False, only=None):
+        is_insert = force_insert or self._get_pk_value() is None
+        rows = super(BaseModel, self).save(force_insert=force_insert, only=only)
+        if not only or is_insert:
+            self._original = dict(self._data)
+        else:  # 只保存了部分字段时，只有这些字段与数据库一致
+            self._original = dict(getattr(self, '_original', None) or {}, **{f.name: self._data.get(f.name) for f in only})
+        if is_insert:
+            self.count_changed(1)
+        return rows
+
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        if recursive and not delete_nullable:  # 与bulk_delete一样集合式级联删除，依赖数据的_rows_changed钩子也会执行
+            with db.atomic():
+                rows = type(self)._cascade_delete([self.id])
+        else:
+            rows = super(BaseModel, self).delete_instance(recursive=recursive, delete_nullable=delete_nullable)
+            self._unmap(self)
+            if recursive:
+                for rel_model in {fk.model_class for fk in self._meta.reverse_rel.values()}:
+                    rel_model.count_changed()
+                    rel_model._unmap()
+        self.count_changed(-rows)
+        return rows
+
+    @classmethod
+    def _rows_changed(cls, ids):
+        """
+        不经过save()批量修改或删除数据行后的钩子，子类用于使相关缓存失效
+        :param ids: [list]
+        :return:
+        """
+
+    @classmethod
+    def _rows_changed_by(cls, fk, values):
+        """
+        级联删除时按外键整批删除（或置为NULL）依赖数据后的钩子，不列出每一行的id；
+        覆盖了_rows_changed且会被级联删除的子类需同时覆盖
+        :param fk: 外键字段
+        :param values: [list] 被删除对象的id
+        :return:
+        """
+
+    @classmethod
+    def _cascade_delete(cls, ids):
+        """
+        集合式级联删除：可为空的外键置为NULL，其余依赖数据按外键整批删除，每层只删除一次（需在事务中调用）
+        依赖数据还有自己的依赖数据时才取出其id逐层删除
+        :param ids: [list] 要删除的对象id
+        :return: [int] 删除的行数
+        """
+        for fk in cls._meta.reverse_rel.values():
+            rel_model = fk.model_class
+            if not fk.null and rel_model._meta.reverse_rel:
+                # 先取出依赖数据的id，避免DELETE ... WHERE id IN (SELECT ... FROM 同一张表)（MySQL错误1093）
+                rel_ids = [_id for _id, in rel_model.select(rel_model.id).where(fk << ids).tuples()]
+                for i in range(0, len(rel_ids), _CASCADE_BATCH_SIZE):
+                    rel_model.count_changed(-rel_model._cascade_delete(rel_ids[i:i + _CASCADE_BATCH_SIZE]))
+                continue
+
+            if fk.null:
+                rel_model.update(**{fk.name: None}).where(fk << ids).execute()
+            else:
+                rel_model.count_changed(-rel_model.delete().where(fk << ids).execute())
+            rel_model._unmap()
+            rel_model._rows_changed_by(fk, ids)
+        cls._unmap()
+        rows = cls.delete().where(cls.id << ids).execute()
+        cls._rows_changed(ids)
+        return rows
+
+    @classmethod
+    def bulk_delete(cls, ids=None, uuids=None):
+        """
+        根据id或uuid批量删除对象（级联删除依赖数据），一次查询确定存在的对象，在同一事务中完成
+        :param ids: [list or None]
+        :param uuids: [list or None]
+        :return: [tuple] (已删除的id/uuid列表, 不存在的id/uuid列表)
+        """
+        def _normalize(_uuid):
+            try:
+                return str(UUID(_uuid))
+            except (TypeError, ValueError):
+                return
+
+        if ids:
+            field, keys = cls.id, [(_id, int(_id)) for _id in ids]
+        else:
+            field, keys = cls.uuid, [(_uuid, _normalize(_uuid)) for _uuid in uuids or []]
+
+        found = {}
+        values = {key for _, key in keys if key is not None}
+        if values:
+            rows = cls.select(cls.id, field).where(field << values).tuples()
+            found = {(key if ids else str(key)): _id for _id, key in rows}
+        deleted = [given for given, key in keys if key in found]
+        missing = [given for given, key in keys if key not in found]
+        if found:
+            with db.atomic():
+                rows = cls._cascade_delete(list(set(found.values())))
+            cls.count_changed(-rows)
+        return deleted, missing
+
+    @classmethod
+    def _ordering(cls, order_by):
+        """
+        解析排序参数
+        :param order_by: [iterable or None] 字段名称，以'-'开头表示降序
+        :return: [(field, desc)]
+        """
+        _fields = cls._meta.fields
+        ordering = []
+        for item in order_by or []:
+            desc, attr = item.startswith('-'), item.lstrip('+-')
+            if attr in cls._exclude_fields():
+                continue
+            if attr in cls._extra_attributes():
+                attr = attr.split('_', 1)[-1]
+            if attr in _fields:
+                ordering.append((_fields[attr], desc))
+        return ordering
+
+    @classmethod
+    def iterator(cls, select_query=None, order_by=None, page=None, per_page=None, dicts=False, fields=None):
         """
         根据查询条件返回迭代器
         :param select_query: [SelectQuery or None]
         :param order_by: [iterable or None]
         :param page:
         :param per_page:
+        :param dicts: [bool] 返回dict数据行而不是对象
+        :param fields: [iterable or None] select_query为None时只查询这些字段（及额外属性）需要的列
         :return:
         """
         try:
+            ordering = cls._ordering(order_by)
             if select_query is None:
-                select_query = cls.select()
+                select_query = cls._select(fields, ordering)
 
-            if order_by:
-                _fields = cls._meta.fields
-                clauses = []
-                for item in order_by:
-                    desc, attr = item.startswith('-'), item.lstrip('+-')
-                    if attr in cls._exclude_fields():
-                        continue
-                    if attr in cls._extra_attributes():
-                        attr = attr.split('_', 1)[-1]
-                    if attr in _fields:
-                        clauses.append(_fields[attr].desc() if desc else _fields[attr])
-                if clauses:
-                    select_query = select_query.order_by(*clauses)
+            if ordering:
+                select_query = select_query.order_by(*[f.desc() if desc else f for f, desc in ordering])
 
             if page or per_page:
                 select_query = select_query.paginate(int(page or 1), int(per_page or DEFAULT_PER_PAGE))
 
-            return select_query.naive().iterator()
+            return (select_query.dicts() if dicts else select_query.naive()).iterator()
 
         except Exception, e:
             current_app.logger.error(e)
             return iter([])
 
+    @classmethod
+    def _encode_cursor(cls, obj, ordering):
+        """
+        生成游标：排序字段及id的值
+        :param obj:
+        :param ordering: [(field, desc)]
+        :return:
+        """
+        values = [f.db_value(obj._data.get(f.name)) for f, desc in ordering]
+        return base64.urlsafe_b64encode(json.dumps(values, default=unicode))
+
+    @classmethod
+    def _decode_cursor(cls, cursor, ordering):
+        """
+        解析游标
+        :param cursor:
+        :param ordering: [(field, desc)]
+        :return: 游标无效时返回None
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            if isinstance(values, list) and len(values) == len(ordering):
+                return values
+        except (TypeError, ValueError):
+            pass
+
+    @classmethod
+    def _keyset_after(cls, ordering, values):
+        """
+        排在游标之后的查询条件：(a > va) OR (a = va AND b > vb) OR ...（MySQL中NULL排在最小）
+        :param ordering: [(field, desc)]
+        :param values:
+        :return:
+        """
+        clauses, equals = [], []
+        for (f, desc), v in zip(ordering, values):
+            if v is None:
+                after = None if desc else ~(f >> None)
+            else:
+                after = ((f < v) | (f >> None)) if desc else (f > v)
+            if after is not None:
+                clauses.append(reduce(operator.and_, equals + [after]))
+            equals.append(f >> None if v is None else f == v)
+        return reduce(operator.or_, clauses) if clauses else SQL('0 = 1')
+
+    @classmethod
+    def cursor_page(cls, select_query=None, order_by=None, after=None, before=None, per_page=None, fields=None):
+        """
+        游标分页（keyset），深分页时不需要像OFFSET一样扫描并丢弃前面的数据
+        :param select_query: [SelectQuery or None]
+        :param order_by: [iterable or None]
+        :param after: 返回排在该游标之后的一页，为空字符串时返回第一页
+        :param before: 返回排在该游标之前的一页
+        :param per_page:
+        :param fields: [iterable or None] select_query为None时只查询这些字段（及额外属性）需要的列
+        :return: (对象列表, 上一页游标, 下一页游标)，游标无效时返回None
+        """
+        try:
+            per_page = int(per_page or DEFAULT_PER_PAGE)
+            ordering = cls._ordering(order_by)
+            if not any(f is cls.id for f, desc in ordering):
+                ordering.append((cls.id, ordering[-1][1] if ordering else False))  # 以id保证顺序唯一
+            if select_query is None:
+                select_query = cls._select(fields, ordering)
+
+            backward = bool(before)
+            query_ordering = [(f, desc != backward) for f, desc in ordering]
+            cursor = before if backward else after
+            if cursor:
+                values = cls._decode_cursor(cursor, ordering)
+                if values is None:
+                    return
+                select_query = select_query.where(cls._keyset_after(query_ordering, values))
+
+            select_query = select_query.order_by(*[f.desc() if desc else f for f, desc in query_ordering])
+            objects = list(select_query.limit(per_page + 1).naive())
+            has_more = len(objects) > per_page
+            objects = objects[:per_page]
+            if backward:
+                objects.reverse()
+
+            first, last = (objects[0], objects[-1]) if objects else (None, None)
+            has_prev, has_next = (has_more, bool(objects)) if backward else (bool(cursor) and bool(objects), has_more)
+            prev_cursor = cls._encode_cursor(first, ordering) if has_prev else None
+            next_cursor = cls._encode_cursor(last, ordering) if has_next else None
+            return objects, prev_cursor, next_cursor
+
+        except Exception, e:
+            current_app.logger.error(e)
+
+    @classmethod
+    def _serializer_plan(cls, only=None, exclude=None):
+        """
+        转换为dict表示时的字段提取计划，按(model, only, exclude)编译一次后缓存
+        only和exclude先与模型的字段、额外属性名称取交集，客户端传入任意名称也不会使缓存无限增长
+        :param only: [iterable or None]
+        :param exclude: [iterable or None]
+        :return: (字段名称tuple, (额外属性名称, 取值函数) tuple)
+        """
+        names = set(cls._meta.fields) | cls._extra_attributes()
+        only = _to_set(only)
+        only = frozenset(only & names) if only else None  # None: 未指定only
+        exclude = frozenset(_to_set(exclude) & names)
+        key = (cls, only, exclude)
+        plan = _serializer_plans.get(key)
+        if plan is None:
+            exclude = exclude | cls._exclude_fields()
+
+            only_fields = (only or set()) & set(cls._meta.fields)
+            extra_attrs = cls._extra_attributes() - exclude
+            if only is not None:
+                extra_attrs &= only
+            if only is not None and not only_fields:
+                field_names = ()
+            else:
+                field_names = tuple(name for name in cls._meta.sorted_field_names
+                                    if name not in exclude and (not only_fields or name in only_fields))
+            extras = []
+            for name in sorted(extra_attrs):
+                attr = getattr(cls, name)
+                extras.append((name, getattr(attr, '__func__', None) or (lambda row, _name=name: getattr(row, _name))))
+            plan = _serializer_plans[key] = (field_names, tuple(extras))
+        return plan
+
+    @classmethod
+    def to_dicts(cls, rows, only=None, exclude=None, columns=None):
+        """
+        批量转换为dict表示，可直接使用dict或tuple数据行而不必创建对象
+        :param rows: [iterable] 对象、dict（select().dicts()）或tuple（须指定columns）
+        :param only: [iterable or None]
+        :param exclude: [iterable or None]
+        :param columns: [iterable or None] tuple数据行中各列对应的字段名称
+        :return:
+        """
+        try:
+            field_names, extras = cls._serializer_plan(only, exclude)
+            columns = tuple(columns) if columns else None
+            result = []
+            for row in rows:
+                if isinstance(row, Model):
+                    data, obj = row._data, row
+                else:
+                    data = dict(zip(columns, row)) if columns else row
+                    obj = _Row(data)
+                item = {name: data.get(name) for name in field_names}
+                for name, f in extras:
+                    item[name] = f(obj)
+                result.append(item)
+            return result
+
+        except Exception, e:
+            current_app.logger.error(e)
+            return []
+
     def to_dict(self, only=None, exclude=None, recurse=False, backrefs=False, max_depth=None):
         """
         转换为dict表示
@@ -144,6 +623,13 @@ class BaseModel(Model):
         :return:
         """
         try:
+            if not (recurse or backrefs):
+                field_names, extras = self._serializer_plan(only, exclude)
+                data = {name: self._data.get(name) for name in field_names}
+                for name, f in extras:
+                    data[name] = f(self)
+                return data
+
             only = _to_set(only)
             exclude = _to_set(exclude) | self._exclude_fields()
 
@@ -163,35 +649,124 @@ class BaseModel(Model):
             current_app.logger.error(e)
             return {}
 
+    def prepared(self):
+        """
+        从数据库读出后记录各字段的原始值，用于判断数值是否有变动
+        :return:
+        """
+        self._original = dict(self._data)
+
     def modified_fields(self, exclude=None):
         """
-        与数据库中对应的数据相比，数值有变动的字段名称列表
+        与从数据库读出（或上次保存）时相比，数值有变动的字段名称列表，不查询数据库
         :param exclude: [iterable or None]
         :return:
         """
         try:
             exclude = _to_set(exclude)
-            db_obj = self.query_by_id(self.id)
-            return filter(lambda f: getattr(self, f) != getattr(db_obj, f) and f not in exclude,
-                          self._meta.sorted_field_names)
+            original = getattr(self, '_original', None)
+            if original is None:  # 尚未保存的对象
+                return [f for f in self._meta.sorted_field_names if f in self._data and f not in exclude]
+
+            def _changed(name):
+                value, original_value = self._data.get(name), original.get(name)
+                if isinstance(original_value, RawJSON) and not isinstance(value, RawJSON):
+                    original_value = original_value.load()  # JSON字段已被解码（可能被原地修改）
+                return value != original_value
+
+            return [f for f in self._meta.sorted_field_names if f not in exclude and _changed(f)]
 
         except Exception, e:
             current_app.logger.error(e)
 
     def save_if_modified(self):
         """
-        如果数值有变动，修改更新时间并持久化到数据库
+        如果数值有变动，修改更新时间并只持久化有变动的字段；没有变动时不访问数据库
         :return:
         """
         try:
-            if self.modified_fields():
-                self.update_time = datetime.datetime.now()
+            if getattr(self, '_original', None) is None:
                 self.save()
+                return self
+
+            modified = self.modified_fields()
+            if modified:
+                self.update_time = datetime.datetime.now()
+                _fields = self._meta.fields
+                self.save(only=[_fields[f] for f in set(modified) | {'update_time'}])
             return self
 
         except Exception, e:
             current_app.logger.error(e)
 
+    @classmethod
+    def bulk_update(cls, objects, fields):
+        """
+        用一条UPDATE ... CASE语句持久化多个对象的指定字段
+        :param objects: [iterable]
+        :param fields: [iterable] 字段名称
+        :return:
+        """
+        objects = list(objects)
+        if not objects:
+            return 0
+
+        _fields = cls._meta.fields
+        update = {}
+        for name in fields:
+            field = _fields[name]
+            update[name] = Case(cls.id, [(obj.id, field.db_value(obj._data.get(name))) for obj in objects], field)
+        ids = [obj.id for obj in objects]
+        rows = cls.update(**update).where(cls.id << ids).execute()
+        for obj in objects:
+            obj.prepared()
+        cls._rows_changed(ids)
+        return rows
+
+    @classmethod
+    def bulk_set_show_weight(cls, items):
+        """
+        批量设置是否展示/排序权重：一次查询取出对象，按字段分组用UPDATE ... CASE语句在同一事务中持久化
+        :param items: [list] [{'id' or 'uuid': ..., 'show': [bool, 可选], 'weight': [int, 可选]}]
+        :return: [list or None] 修改后的对象（与items顺序一致），有对象不存在时返回None
+        """
+        ids = {int(item['id']) for item in items if item.get('id') is not None}
+        uuids = {str(item['uuid']) for item in items if item.get('id') is None}
+        try:
+            uuids = {str(UUID(_uuid)) for _uuid in uuids}
+        except (TypeError, ValueError):
+            return
+
+        condition = []
+        if ids:
+            condition.append(cls.id << ids)
+        if uuids:
+            condition.append(cls.uuid << uuids)
+        if not condition:
+            return []
+        by_id, by_uuid = {}, {}
+        for obj in cls.select().where(reduce(operator.or_, condition)):
+            by_id[obj.id], by_uuid[str(obj.uuid)] = obj, obj
+
+        objects, modified = [], {'show': [], 'weight': []}
+        for item in items:
+            if item.get('id') is not None:
+                obj = by_id.get(int(item['id']))
+            else:
+                obj = by_uuid.get(str(UUID(str(item['uuid']))))
+            if obj is None:
+                return
+            for name in modified:
+                if name in item:
+                    setattr(obj, name, item[name])
+                    modified[name].append(obj)
+            objects.append(obj)
+
+        with db.atomic():
+            for name, objs in modified.iteritems():
+                cls.bulk_update(objs, [name])
+        return objects
+
     def set_show(self, show):
         """
         设置是否展示
@@ -237,13 +812,14 @@ class Admin(BaseModel):
     last_login_time = DateTimeField(null=True)  # 最近登录时间
     last_login_ip = CharField(null=True)  # 最近登录IP
     authority = BigIntegerField(default=0)  # 权限
+    token_version = IntegerField(default=0)  # 身份令牌版本号（修改密码或退出登录时加1，使之前签发的令牌全部失效）
 
     class Meta:
         db_table = 'admin'
 
     @classmethod
     def _exclude_fields(cls):
-        return BaseModel._exclude_fields() | {'password', 'last_login_time'}
+        return BaseModel._exclude_fields() | {'password', 'last_login_time', 'token_version'}
 
     @classmethod
     def _extra_attributes(cls):
@@ -283,18 +859,61 @@ class Admin(BaseModel):
         except Exception, e:
             current_app.logger.error(e)
 
+    @classmethod
+    def _token_version_key(cls, _id):
+        """
+        身份令牌版本号在redis中的缓存key（以数据库为准，只用于写入验证结果缓存后的复核）
+        :param _id:
+        :return:
+        """
+        return 'admin:%s:token_version' % _id
+
+    @classmethod
+    def _token_cache_key(cls, token):
+        """
+        身份令牌验证结果的缓存key
+        :param token:
+        :return:
+        """
+        return 'admin:token:%s' % hashlib.sha256(token).hexdigest()
+
     @classmethod
     def query_by_token(cls, token):
         """
-        根据身份令牌查询
+        根据身份令牌查询：验证结果缓存命中时不解密令牌也不查询数据库
         :param token:
         :return:
         """
         try:
-            tag, _id, expires = decrypt(token).split(':')
+            key = cls._token_cache_key(token)
+            cached = loads_signed(cached_get(key)) if CACHE_SIGNING_KEY else None
+            if cached is not None and cached['expires'] > time.time():
+                return cls._map(cls._from_data(cached['admin']))
+
+            items = decrypt(token).split(':')
+            tag, _id, expires = items[:3]
+            version = int(items[3]) if len(items) > 3 else 0  # 兼容不带版本号的旧令牌
             assert tag == ADMIN_TOKEN_TAG, 'token tag: %s' % tag
             assert int(expires) > time.time(), 'token expired'
-            return cls.query_by_id(_id)
+            admin = cls.query_by_id(_id)
+            if admin is None:
+                return
+            assert version == (admin.token_version or 0), 'token revoked'
+            if CACHE_SIGNING_KEY:
+                data = dict(admin._original)
+                data.pop('password', None)  # 缓存中不保存密码哈希
+                cached = {
+                    'id': admin.id,
+                    'expires': int(expires),
+                    'version': version,
+                    'admin': data
+                }
+                ttl = max(min(ADMIN_TOKEN_CACHE_TTL, int(expires) - int(time.time())), 1)
+                set_indexed(key, dumps_signed(cached), ttl, 'admin:%s:tokens' % admin.id, ADMIN_TOKEN_CACHE_TTL)
+                cached_version = redis_client.get(cls._token_version_key(admin.id))
+                if cached_version is not None and int(cached_version) != version:  # 写入缓存期间令牌被吊销
+                    redis_client.delete(key)
+            return admin
 
         except Exception, e:
             current_app.logger.error(e)
@@ -304,7 +923,69 @@ class Admin(BaseModel):
         生成身份令牌
         :return:
         """
-        return encrypt('%s:%s:%s' % (ADMIN_TOKEN_TAG, self.id, int(time.time()) + 86400 * ADMIN_TOKEN_VALID_DAYS))
+        expires = int(time.time()) + 86400 * ADMIN_TOKEN_VALID_DAYS
+        return encrypt('%s:%s:%s:%s' % (ADMIN_TOKEN_TAG, self.id, expires, self.token_version or 0))
+
+    def revoke_tokens(self):
+        """
+        吊销已签发的全部身份令牌：数据库中的版本号加1，redis中只缓存新版本号
+        :return:
+        """
+        try:
+            cls = type(self)
+            with db.atomic():
+                cls.update(token_version=cls.token_version + 1).where(cls.id == self.id).execute()
+                version = cls.select(cls.token_version).where(cls.id == self.id).scalar()
+            self._set_clean('token_version', version)
+            redis_client.set(self._token_version_key(self.id), version, ex=ADMIN_TOKEN_CACHE_TTL)
+            self.expire_tokens()
+            return self
+
+        except Exception, e:
+            current_app.logger.error(e)
+
+    def expire_tokens(self):
+        """
+        使身份令牌验证结果的缓存失效（在事务中时等到提交后）
+        :return:
+        """
+        self._rows_changed([self.id])
+
+    @classmethod
+    def _rows_changed(cls, ids):
+        index_keys = ['admin:%s:tokens' % _id for _id in ids]
+        db.on_commit(lambda: delete_indexed(*index_keys))
+
+    def _set_clean(self, name, value):
+        """
+        设置与数据库一致的字段值（不标记为已修改）
+        :param name:
+        :param value:
+        :return:
+        """
+        self._data[name] = value
+        if getattr(self, '_original', None) is not None:
+            self._original[name] = value
+
+    def save(self, force_insert=False, only=None):
+        is_insert = force_insert or self._get_pk_value() is None
+        if not is_insert:
+            # 只写入修改过的字段（only_save_dirty）：对象可能由令牌缓存恢复，未修改的字段可能已过时；
+            # token_version只由revoke_tokens原子地修改，不随保存写回
+            self._dirty.discard('token_version')
+            if only is not None:
+                only = [f for f in only if f.name != 'token_version']
+                if not only:
+                    return 0
+        rows = super(Admin, self).save(force_insert=force_insert, only=only)
+        if not is_insert:
+            self.expire_tokens()
+        return rows
+
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        rows = super(Admin, self).delete_instance(recursive=recursive, delete_nullable=delete_nullable)
+        self.expire_tokens()
+        return rows
 
     def check_password(self, password):
         """
@@ -312,6 +993,9 @@ class Admin(BaseModel):
         :param password:
         :return:
         """
+        if 'password' not in self._data:  # 由令牌缓存恢复的对象不含密码哈希
+            cls = type(self)
+            self._set_clean('password', cls.select(cls.password).where(cls.id == self.id).scalar())
         return check_password_hash(self.password, password)
 
     def change_password(self, password):
@@ -324,6 +1008,7 @@ class Admin(BaseModel):
             self.password = generate_password_hash(password)
             self.update_time = datetime.datetime.now()
             self.save()
+            self.revoke_tokens()
             return self
 
         except Exception, e:
@@ -355,9 +1040,9 @@ class WXAuthorizer(BaseModel):
     authorized = BooleanField(default=True)  # 是否已授权
     appid = CharField(max_length=40, unique=True)
     refresh_token = CharField()
-    func_info = TextField()
+    func_info = JSONField()
 
-    authorizer_info = TextField(null=True)
+    authorizer_info = JSONField(null=True)
     service_type = IntegerField(null=True)
     verify_type = IntegerField(null=True)
     nick_name = CharField(null=True)
@@ -367,12 +1052,16 @@ class WXAuthorizer(BaseModel):
     principal_name = CharField(null=True)
     user_name = CharField(null=True)
     alias = CharField(null=True)
-    business_info = TextField(null=True)
-    mini_program_info = TextField(null=True)
+    business_info = JSONField(null=True)
+    mini_program_info = JSONField(null=True)
 
     class Meta:
         db_table = 'wx_authorizer'
 
+    @classmethod
+    def _identity_keys(cls, obj):
+        return BaseModel._identity_keys(obj) + [('appid', obj.appid)]
+
     @classmethod
     def _exclude_fields(cls):
         return BaseModel._exclude_fields() | {'refresh_token', 'func_info', 'authorizer_info', 'business_info',
@@ -383,19 +1072,136 @@ class WXAuthorizer(BaseModel):
         return BaseModel._extra_attributes() | {'array_func_info', 'dict_authorizer_info', 'dict_business_info',
                                                 'dict_mini_program_info'}
 
+    @classmethod
+    def _row_cache_key(cls, name, value):
+        """
+        数据行在redis中的缓存key
+        :param name: 'id', 'appid'
+        :param value:
+        :return:
+        """
+        return 'wx_authorizer:row:%s:%s' % (name, value)
+
+    @classmethod
+    def _from_row_cache(cls, name, value):
+        """
+        从共享缓存（进程内缓存 & redis）恢复对象，未命中时返回None
+        :param name: 'id', 'appid'
+        :param value:
+        :return:
+        """
+        if not CACHE_SIGNING_KEY:
+            return
+
+        data = loads_signed(cached_get(cls._row_cache_key(name, value)))
+        if data is not None:
+            return cls._from_data(data)
+
+    def _cache_row(self):
+        """
+        读数据库后回源填充共享缓存（按id和appid）：缓存已存在时不覆盖；
+        在事务中读到的数据可能未提交，不填充
+        :return:
+        """
+        if not CACHE_SIGNING_KEY or db.transaction_depth() > 0:
+            return self
+
+        if not set(self._meta.fields) <= set(self._original):  # 不是完整的数据行
+            return self
+
+        blob = dumps_signed(dict(self._original))
+        for name in ('id', 'appid'):
+            redis_client.set(self._row_cache_key(name, self._original[name]), blob, ex=WX_AUTHORIZER_CACHE_TTL, nx=True)
+        return self
+
+    @classmethod
+    def _uncache_rows(cls, rows):
+        """
+        在事务提交后使数据行的共享缓存失效（不写入新数据，由下次读取从数据库回源），
+        避免并发读取在提交前读到旧数据并重新填充缓存
+        :param rows: [iterable] (id, appid)
+        :return:
+        """
+        keys = [cls._row_cache_key(name, value) for row in rows for name, value in zip(('id', 'appid'), row)]
+        if keys and CACHE_SIGNING_KEY:
+            def _delete():
+                redis_client.delete(*keys)
+                invalidate(*keys)
+            db.on_commit(_delete)
+
+    @classmethod
+    def _query_by(cls, name, value):
+        """
+        依次从请求内对象映射、共享缓存、数据库查询
+        :param name: 'id', 'appid'
+        :param value:
+        :return:
+        """
+        obj = cls._mapped(name, value) or cls._map(cls._from_row_cache(name, value))
+        if obj is None:
+            obj = cls._map(cls.get(getattr(cls, name) == value))._cache_row()
+        return obj
+
+    @classmethod
+    def query_by_id(cls, _id, fields=None):
+        """
+        根据id查询（不指定fields时使用请求内对象映射和共享缓存）
+        :param _id:
+        :param fields: [iterable or None]
+        :return:
+        """
+        if fields:
+            return super(WXAuthorizer, cls).query_by_id(_id, fields)
+
+        authorizer = None
+        try:
+            authorizer = cls._query_by('id', int(_id))
+        finally:
+            return authorizer
+
     @classmethod
     def query_by_appid(cls, appid):
         """
-        根据appid查询
+        根据appid查询（使用请求内对象映射和共享缓存）
         :param appid:
         :return:
         """
         authorizer = None
         try:
-            authorizer = cls.get(cls.appid == appid)
+            authorizer = cls._query_by('appid', appid)
         finally:
             return authorizer
 
+    def save(self, force_insert=False, only=None):
+        is_insert = force_insert or self._get_pk_value() is None
+        original_appid = (getattr(self, '_original', None) or {}).get('appid', self.appid)
+        rows = super(WXAuthorizer, self).save(force_insert=force_insert, only=only)
+        if not is_insert:
+            self._uncache_rows({(self.id, original_appid), (self.id, self.appid)})
+        return rows
+
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        rows = super(WXAuthorizer, self).delete_instance(recursive=recursive, delete_nullable=delete_nullable)
+        self._uncache_rows([(self.id, self.appid)])
+        return rows
+
+    @classmethod
+    def _rows_changed(cls, ids):
+        if not CACHE_SIGNING_KEY:
+            return
+
+        # 已删除的行只能按id失效（appid由_cascade_delete处理）
+        rows = dict((_id, None) for _id in ids)
+        rows.update(cls.select(cls.id, cls.appid).where(cls.id << ids).tuples())
+        cls._uncache_rows([(_id, appid) if appid else (_id,) for _id, appid in rows.iteritems()])
+
+    @classmethod
+    def _cascade_delete(cls, ids):
+        rows = list(cls.select(cls.id, cls.appid).where(cls.id << ids).tuples())
+        cnt = super(WXAuthorizer, cls)._cascade_delete(ids)
+        cls._uncache_rows(rows)
+        return cnt
+
     @classmethod
     def create_wx_authorizer(cls, appid, refresh_token, func_info):
         """
@@ -409,7 +1215,7 @@ class WXAuthorizer(BaseModel):
             return cls.create(
                 appid=appid.strip(),
                 refresh_token=refresh_token.strip(),
-                func_info=repr(func_info)
+                func_info=func_info
             )
 
         except Exception, e:
@@ -425,6 +1231,8 @@ class WXAuthorizer(BaseModel):
                 self.authorized = False
                 self.update_time = datetime.datetime.now()
                 self.save()
+            redis_client.delete(*map(self._token_key, ('access_token', 'jsapi_ticket', 'card_api_ticket')))
+            invalidate(self._token_key('*'))
             return self
 
         except Exception, e:
@@ -453,8 +1261,8 @@ class WXAuthorizer(BaseModel):
         :return:
         """
         try:
-            if self.func_info != repr(func_info):
-                self.func_info = repr(func_info)
+            if self.func_info != func_info:
+                self.func_info = func_info
                 self.update_time = datetime.datetime.now()
                 self.save()
             return self
@@ -481,7 +1289,7 @@ class WXAuthorizer(BaseModel):
                 'component_appid': wx['app_id'],
                 'authorizer_appid': self.appid
             }
-            resp_json = requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+            resp_json = http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
             authorizer_info, authorization_info = map(resp_json.get, ('authorizer_info', 'authorization_info'))
             if not (authorizer_info and authorization_info):
                 return
@@ -493,8 +1301,8 @@ class WXAuthorizer(BaseModel):
                  'principal_name', 'user_name', 'alias', 'business_info', 'MiniProgramInfo')
             )
             self.authorized = True
-            self.func_info = repr(authorization_info.get('func_info'))
-            self.authorizer_info = repr(authorizer_info)
+            self.func_info = authorization_info.get('func_info')
+            self.authorizer_info = authorizer_info
             self.service_type = service_type_info.get('id') if service_type_info else None
             self.verify_type = verify_type_info.get('id') if verify_type_info else None
             self.nick_name = _nullable_strip(nick_name)
@@ -504,23 +1312,40 @@ class WXAuthorizer(BaseModel):
             self.principal_name = _nullable_strip(principal_name)
             self.user_name = _nullable_strip(user_name)
             self.alias = _nullable_strip(alias)
-            self.business_info = repr(business_info) if business_info else None
-            self.mini_program_info = repr(mini_program_info) if mini_program_info else None
+            self.business_info = business_info or None
+            self.mini_program_info = mini_program_info or None
             return self.save_if_modified()
 
         except Exception, e:
             current_app.logger.error(e)
 
-    def get_access_token(self):
+    def _token_key(self, name):
         """
-        获取access_token
+        接口调用凭证的缓存key
+        :param name: 'access_token', 'jsapi_ticket', 'card_api_ticket'
         :return:
         """
-        key = 'wx_authorizer:%s:access_token' % self.appid
-        access_token = redis_client.get(key)
-        if access_token:
-            return access_token
+        return 'wx_authorizer:%s:%s' % (self.appid, name)
 
+    def _get_token(self, name, loader):
+        """
+        从缓存获取接口调用凭证；未命中且允许同步刷新时，由单个进程调用微信接口
+        :param name:
+        :param loader:
+        :return:
+        """
+        key = self._token_key(name)
+        token = cached_get(key)
+        if token or not current_app.config['WEIXIN']['token_sync_refresh']:
+            return token
+
+        return single_flight(key, loader)
+
+    def _request_access_token(self):
+        """
+        调用微信接口获取access_token并缓存
+        :return:
+        """
         wx = current_app.config['WEIXIN']
         component_access_token = get_component_access_token(wx)
         if not component_access_token:
@@ -535,7 +1360,7 @@ class WXAuthorizer(BaseModel):
             'authorizer_appid': self.appid,
             'authorizer_refresh_token': self.refresh_token
         }
-        resp_json = requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        resp_json = http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
         access_token, expires_in, refresh_token = map(
             resp_json.get,
             ('authorizer_access_token', 'expires_in', 'authorizer_refresh_token')
@@ -544,19 +1369,16 @@ class WXAuthorizer(BaseModel):
             return
 
         self.update_refresh_token(refresh_token)
-        redis_client.set(key, access_token, ex=int(expires_in) - 600)  # 提前10分钟更新access_token
+        set_token(self._token_key('access_token'), access_token, expires_in)
         return access_token
 
-    def get_jsapi_ticket(self):
+    def _request_ticket(self, name, ticket_type):
         """
-        获取jsapi_ticket
+        调用微信接口获取jsapi_ticket/card_api_ticket并缓存
+        :param name: 'jsapi_ticket', 'card_api_ticket'
+        :param ticket_type: 'jsapi', 'wx_card'
         :return:
         """
-        key = 'wx_authorizer:%s:jsapi_ticket' % self.appid
-        jsapi_ticket = redis_client.get(key)
-        if jsapi_ticket:
-            return jsapi_ticket
-
         access_token = self.get_access_token()
         if not access_token:
             return
@@ -564,42 +1386,69 @@ class WXAuthorizer(BaseModel):
         wx_url = 'https://api.weixin.qq.com/cgi-bin/ticket/getticket'
         params = {
             'access_token': access_token,
-            'type': 'jsapi'
+            'type': ticket_type
         }
-        resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
-        jsapi_ticket, expires_in = map(resp_json.get, ('ticket', 'expires_in'))
-        if not (jsapi_ticket and expires_in):
+        resp_json = http_client.get(wx_url, params=params, verify=VERIFY).json()
+        ticket, expires_in = map(resp_json.get, ('ticket', 'expires_in'))
+        if not (ticket and expires_in):
             return
 
-        redis_client.set(key, jsapi_ticket, ex=int(expires_in) - 600)  # 提前10分钟更新jsapi_ticket
-        return jsapi_ticket
+        set_token(self._token_key(name), ticket, expires_in)
+        return ticket
+
+    def get_access_token(self):
+        """
+        获取access_token
+        :return:
+        """
+        return self._get_token('access_token', self._request_access_token)
+
+    def _mark_ticket_in_use(self, name):
+        """
+        标记ticket最近使用过（每个进程每小时最多写一次redis），定时任务只提前刷新使用中的ticket
+        :param name: 'jsapi_ticket', 'card_api_ticket'
+        :return:
+        """
+        key = self._token_key(name)
+        now = time.time()
+        if now - _tickets_in_use.get(key, 0) >= 3600:
+            redis_client.set('%s:in_use' % key, 1, ex=TICKET_IN_USE_TTL)
+            _tickets_in_use[key] = now
+
+    def get_jsapi_ticket(self):
+        """
+        获取jsapi_ticket
+        :return:
+        """
+        self._mark_ticket_in_use('jsapi_ticket')
+        return self._get_token('jsapi_ticket', lambda: self._request_ticket('jsapi_ticket', 'jsapi'))
 
     def get_card_api_ticket(self):
         """
         获取微信卡券api_ticket
         :return:
         """
-        key = 'wx_authorizer:%s:card_api_ticket' % self.appid
-        card_api_ticket = redis_client.get(key)
-        if card_api_ticket:
-            return card_api_ticket
+        self._mark_ticket_in_use('card_api_ticket')
+        return self._get_token('card_api_ticket', lambda: self._request_ticket('card_api_ticket', 'wx_card'))
 
-        access_token = self.get_access_token()
-        if not access_token:
-            return
-
-        wx_url = 'https://api.weixin.qq.com/cgi-bin/ticket/getticket'
-        params = {
-            'access_token': access_token,
-            'type': 'wx_card'
-        }
-        resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
-        card_api_ticket, expires_in = map(resp_json.get, ('ticket', 'expires_in'))
-        if not (card_api_ticket and expires_in):
-            return
+    def refresh_tokens(self):
+        """
+        在接口调用凭证过期前提前刷新（由定时任务调用）：获取失败时按凭证指数退避，ticket只刷新最近使用过的
+        :return:
+        """
+        try:
+            refresh_ahead(self._token_key('access_token'), self._request_access_token, TOKEN_REFRESH_AHEAD)
+            if self.mini_program_info:  # 小程序没有jsapi_ticket/card_api_ticket
+                return self
+
+            for name, ticket_type in (('jsapi_ticket', 'jsapi'), ('card_api_ticket', 'wx_card')):
+                key = self._token_key(name)
+                if redis_client.exists('%s:in_use' % key):
+                    refresh_ahead(key, lambda: self._request_ticket(name, ticket_type), TOKEN_REFRESH_AHEAD)
+            return self
 
-        redis_client.set(key, card_api_ticket, ex=int(expires_in) - 600)  # 提前10分钟更新card_api_ticket
-        return card_api_ticket
+        except Exception, e:
+            current_app.logger.error(e)
 
     def get_user_info(self, openid):
         """
@@ -617,12 +1466,61 @@ class WXAuthorizer(BaseModel):
             'openid': openid,
             'lang': 'zh_CN'
         }
-        resp = requests.get(wx_url, params=params, verify=VERIFY)
+        resp = http_client.get(wx_url, params=params, verify=VERIFY)
         resp.encoding = 'utf-8'
         info = resp.json()
         if not info.get('errcode'):
             return info
 
+    def get_users_info(self, openids):
+        """
+        批量获取微信用户基本信息
+        :param openids: [list]
+        :return: 任一请求失败时返回None
+        """
+        access_token = self.get_access_token()
+        if not access_token:
+            return
+
+        wx_url = 'https://api.weixin.qq.com/cgi-bin/user/info/batchget'
+        params = {
+            'access_token': access_token
+        }
+        infos = []
+        for i in range(0, len(openids), WX_USER_INFO_BATCH_SIZE):
+            data = {
+                'user_list': [{'openid': openid, 'lang': 'zh_CN'} for openid in openids[i:i + WX_USER_INFO_BATCH_SIZE]]
+            }
+            resp = http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY)
+            resp.encoding = 'utf-8'
+            user_info_list = resp.json().get('user_info_list')
+            if user_info_list is None:
+                return
+            infos.extend(user_info_list)
+        return infos
+
+    def get_followers(self, next_openid=None):
+        """
+        获取关注者列表（每次最多10000个openid）
+        :param next_openid: 从该openid之后开始拉取，为空时从头开始
+        :return: (关注者总数, openid列表, next_openid)
+        """
+        access_token = self.get_access_token()
+        if not access_token:
+            return
+
+        wx_url = 'https://api.weixin.qq.com/cgi-bin/user/get'
+        params = {
+            'access_token': access_token,
+            'next_openid': next_openid or ''
+        }
+        resp_json = http_client.get(wx_url, params=params, verify=VERIFY).json()
+        if resp_json.get('errcode'):
+            return
+
+        openids = (resp_json.get('data') or {}).get('openid') or []
+        return resp_json.get('total'), openids, resp_json.get('next_openid')
+
     def get_user_info_with_authorization(self, code):
         """
         获取微信用户基本信息（网页授权）
@@ -643,7 +1541,7 @@ class WXAuthorizer(BaseModel):
             'component_appid': wx['app_id'],
             'component_access_token': component_access_token
         }
-        resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
+        resp_json = http_client.get(wx_url, params=params, verify=VERIFY).json()
         access_token, openid, refresh_token = map(resp_json.get, ('access_token', 'openid', 'refresh_token'))
         if not (access_token and openid):
             return
@@ -655,7 +1553,7 @@ class WXAuthorizer(BaseModel):
             'openid': openid,
             'lang': 'zh_CN'
         }
-        resp = requests.get(wx_url, params=params, verify=VERIFY)
+        resp = http_client.get(wx_url, params=params, verify=VERIFY)
         resp.encoding = 'utf-8'
         info = resp.json()
         if not info.get('errcode'):
@@ -676,7 +1574,7 @@ class WXAuthorizer(BaseModel):
             'access_token': access_token,
             'media_id': media_id
         }
-        resp = requests.get(wx_url, params=params, verify=VERIFY)
+        resp = http_client.get(wx_url, params=params, verify=VERIFY)
         content_type = resp.headers.get('Content-Type')
         if content_type and content_type.startswith('image/'):
             return resp.content
@@ -702,7 +1600,7 @@ class WXAuthorizer(BaseModel):
         files = {
             'media': (file_name, file_data, content_type)
         }
-        return requests.post(wx_url, params=params, files=files, verify=VERIFY).json().get('media_id')
+        return http_client.post(wx_url, params=params, files=files, verify=VERIFY).json().get('media_id')
 
     def send_custom_message(self, openid, msg_type, msg_data):
         """
@@ -725,7 +1623,7 @@ class WXAuthorizer(BaseModel):
             'msgtype': str(msg_type),
             str(msg_type): msg_data
         }
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
 
     def send_template_message(self, openid, template_id, msg_data, url=None, miniprogram=None):
         """
@@ -754,7 +1652,7 @@ class WXAuthorizer(BaseModel):
             data['url'] = str(url)
         if miniprogram:
             data['miniprogram'] = miniprogram
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
 
     def create_menu(self, buttons):
         """
@@ -773,7 +1671,7 @@ class WXAuthorizer(BaseModel):
         data = {
             'button': buttons
         }
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
 
     def generate_qrcode_with_scene(self, action, scene, expires=60):
         """
@@ -800,7 +1698,7 @@ class WXAuthorizer(BaseModel):
         }
         if not action.startswith('QR_LIMIT_'):
             data['expire_seconds'] = int(expires)
-        resp_json = requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        resp_json = http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
         url, ticket = map(resp_json.get, ('url', 'ticket'))
         if not (url and ticket):
             return
@@ -809,7 +1707,7 @@ class WXAuthorizer(BaseModel):
         params = {
             'ticket': ticket
         }
-        resp = requests.get(wx_url, params=params, verify=VERIFY)
+        resp = http_client.get(wx_url, params=params, verify=VERIFY)
         content_type = resp.headers.get('Content-Type')
         if content_type and content_type.startswith('image/'):
             return url, resp.url, resp.content
@@ -860,7 +1758,7 @@ class WXAuthorizer(BaseModel):
                 str(card_type).lower(): card_info
             }
         }
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('card_id')
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('card_id')
 
     def get_card(self, card_id):
         """
@@ -879,7 +1777,7 @@ class WXAuthorizer(BaseModel):
         data = {
             'card_id': str(card_id)
         }
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('card')
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('card')
 
     def modify_card_stock(self, card_id, increase_stock_value):
         """
@@ -903,7 +1801,7 @@ class WXAuthorizer(BaseModel):
             data['increase_stock_value'] = increase_stock_value
         else:
             data['reduce_stock_value'] = -increase_stock_value
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
 
     def delete_card(self, card_id):
         """
@@ -922,7 +1820,7 @@ class WXAuthorizer(BaseModel):
         data = {
             'card_id': str(card_id)
         }
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
 
     def decrypt_card_code(self, encrypt_code):
         """
@@ -941,7 +1839,7 @@ class WXAuthorizer(BaseModel):
         data = {
             'encrypt_code': str(encrypt_code)
         }
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('code')
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('code')
 
     def get_card_code(self, code, card_id=None, check_consume=False):
         """
@@ -965,7 +1863,7 @@ class WXAuthorizer(BaseModel):
         }
         if card_id:
             data['card_id'] = str(card_id)
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
 
     def consume_card_code(self, code, card_id=None):
         """
@@ -987,7 +1885,7 @@ class WXAuthorizer(BaseModel):
         }
         if card_id:
             data['card_id'] = str(card_id)
-        return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+        return http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
 
     def generate_card_sign(self, data):
         """
@@ -1048,23 +1946,23 @@ class WXAuthorizer(BaseModel):
         return params
 
     def array_func_info(self):
-        return [item['funcscope_category']['id'] for item in eval(self.func_info)]
+        return [item['funcscope_category']['id'] for item in self.func_info or []]
 
     def dict_authorizer_info(self):
-        return eval(self.authorizer_info) if self.authorizer_info else {}
+        return self.authorizer_info or {}
 
     def dict_business_info(self):
-        return eval(self.business_info) if self.business_info else {}
+        return self.business_info or {}
 
     def dict_mini_program_info(self):
-        return eval(self.mini_program_info) if self.mini_program_info else {}
+        return self.mini_program_info or {}
 
 
 class WXUser(BaseModel):
     """
     微信用户
     """
-    wx_authorizer = ForeignKeyField(WXAuthorizer, on_delete='CASCADE')
+    wx_authorizer = MappedForeignKeyField(WXAuthorizer, on_delete='CASCADE')
     openid = CharField(max_length=40, index=True)
     unionid = CharField(null=True)
     nickname = CharField(null=True)
@@ -1082,6 +1980,13 @@ class WXUser(BaseModel):
 
     class Meta:
         db_table = 'wx_user'
+        indexes = (
+            (('wx_authorizer', 'openid'), True),
+        )
+
+    @classmethod
+    def _identity_keys(cls, obj):
+        return BaseModel._identity_keys(obj) + [('openid', (obj._data.get('wx_authorizer'), obj.openid))]
 
     @classmethod
     def _exclude_fields(cls):
@@ -1094,24 +1999,89 @@ class WXUser(BaseModel):
     @classmethod
     def query_by_openid(cls, wx_authorizer, openid):
         """
-        根据openid查询
+        根据openid查询（使用请求内对象映射）
         :param wx_authorizer:
         :param openid:
         :return:
         """
         wx_user = None
         try:
-            wx_user = cls.get(cls.wx_authorizer == wx_authorizer, cls.openid == openid)
+            key = (getattr(wx_authorizer, 'id', wx_authorizer), openid)
+            wx_user = cls._mapped('openid', key) or cls._map(cls.get(cls.wx_authorizer == wx_authorizer,
+                                                                     cls.openid == openid))
         finally:
             return wx_user
 
     @classmethod
-    def create_wx_user(cls, wx_authorizer, openid, unionid=None, nickname=None, sex=None, country=None, province=None,
-                       city=None, headimgurl=None, subscribe=None, subscribe_time=None, language=None, remark=None,
-                       tagid_list=None, **kwargs):
+    def _session_key(cls, token):
         """
-        创建微信用户
-        :param wx_authorizer:
+        cookie对应的会话缓存key
+        :param token:
+        :return:
+        """
+        return 'wx_user:session:%s' % hashlib.sha256(token).hexdigest()
+
+    @classmethod
+    def query_by_session(cls, token):
+        """
+        根据cookie查询微信用户：会话缓存命中时不解密cookie也不查询数据库，未命中时解密查询并建立会话
+        :param token: cookie值
+        :return: (wx_user, 是否新建了会话)
+        """
+        key = cls._session_key(token)
+        session = loads_signed(cached_get(key)) if CACHE_SIGNING_KEY else None
+        if session is not None:
+            return cls._map(cls._from_data(session['user'])), False
+
+        wx_user = cls.query_by_uuid(decrypt(token))
+        if wx_user and CACHE_SIGNING_KEY:
+            session = {
+                'user_id': wx_user.id,
+                'wx_authorizer_id': wx_user.wx_authorizer_id,
+                'user': dict(wx_user._original)
+            }
+            set_indexed(key, dumps_signed(session), WX_USER_SESSION_TTL,
+                        ['wx_user:%s:sessions' % wx_user.id, 'wx_authorizer:%s:sessions' % wx_user.wx_authorizer_id])
+        return wx_user, True
+
+    @classmethod
+    def expire_sessions(cls, ids):
+        """
+        微信用户数据变动后使其全部会话缓存失效（在事务中时等到提交后，避免并发请求用旧数据重建会话）
+        :param ids: [iterable]
+        :return:
+        """
+        index_keys = ['wx_user:%s:sessions' % _id for _id in ids]
+        db.on_commit(lambda: delete_indexed(*index_keys))
+
+    @classmethod
+    def _rows_changed(cls, ids):
+        cls.expire_sessions(ids)
+
+    @classmethod
+    def _rows_changed_by(cls, fk, values):
+        if fk is cls.wx_authorizer:  # 微信授权方被删除：按授权方使会话缓存失效
+            index_keys = ['wx_authorizer:%s:sessions' % value for value in values]
+            db.on_commit(lambda: delete_indexed(*index_keys))
+
+    def save(self, force_insert=False, only=None):
+        is_insert = force_insert or self._get_pk_value() is None
+        rows = super(WXUser, self).save(force_insert=force_insert, only=only)
+        if not is_insert:
+            self.expire_sessions([self.id])
+        return rows
+
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        rows = super(WXUser, self).delete_instance(recursive=recursive, delete_nullable=delete_nullable)
+        self.expire_sessions([self.id])
+        return rows
+
+    @classmethod
+    def _info_to_row(cls, openid, unionid=None, nickname=None, sex=None, country=None, province=None, city=None,
+                     headimgurl=None, subscribe=None, subscribe_time=None, language=None, remark=None,
+                     tagid_list=None, **kwargs):
+        """
+        微信用户基本信息转换为数据行
         :param openid:
         :param unionid:
         :param nickname:
@@ -1128,35 +2098,103 @@ class WXUser(BaseModel):
         :param kwargs:
         :return:
         """
+        openid, unionid, nickname, country, province, city, headimgurl, language, remark = map(
+            _nullable_strip,
+            (openid, unionid, nickname, country, province, city, headimgurl, language, remark)
+        )
+        return {
+            'openid': openid,
+            'unionid': unionid,
+            'nickname': nickname,
+            'sex': sex,
+            'country': country,
+            'province': province,
+            'city': city,
+            'headimgurl': headimgurl,
+            'subscribe': subscribe,
+            'subscribe_time': subscribe_time,
+            'language': language,
+            'remark': remark,
+            'tagid_list': ','.join(map(str, tagid_list)) if tagid_list else None
+        }
+
+    @classmethod
+    def create_wx_user(cls, wx_authorizer, openid, **info):
+        """
+        创建微信用户
+        :param wx_authorizer:
+        :param openid:
+        :param info: 微信用户基本信息，参见_info_to_row
+        :return:
+        """
         try:
-            openid, unionid, nickname, country, province, city, headimgurl, language, remark = map(
-                _nullable_strip,
-                (openid, unionid, nickname, country, province, city, headimgurl, language, remark)
-            )
-            return cls.create(
-                wx_authorizer=wx_authorizer,
-                openid=openid,
-                unionid=unionid,
-                nickname=nickname,
-                sex=sex,
-                country=country,
-                province=province,
-                city=city,
-                headimgurl=headimgurl,
-                subscribe=subscribe,
-                subscribe_time=subscribe_time,
-                language=language,
-                remark=remark,
-                tagid_list=','.join(map(str, tagid_list)) if tagid_list else None
-            )
+            with db.atomic():
+                return cls.create(wx_authorizer=wx_authorizer, **cls._info_to_row(openid, **info))
+
+        except IntegrityError:  # 并发创建了同一用户（唯一索引(wx_authorizer_id, openid)）
+            return cls.query_by_openid(wx_authorizer, openid)
 
         except Exception, e:
             current_app.logger.error(e)
 
-    def update_wx_user(self, subscribe, unionid=None, nickname=None, sex=None, country=None, province=None, city=None,
-                       headimgurl=None, subscribe_time=None, language=None, remark=None, tagid_list=None, **kwargs):
+    @classmethod
+    def bulk_sync_wx_users(cls, wx_authorizer, infos, create_unsubscribed=True):
         """
-        更新微信用户
+        批量创建或更新微信用户：新用户一次多行INSERT ... ON DUPLICATE KEY UPDATE，有变动的老用户一次UPDATE
+        :param wx_authorizer:
+        :param infos: [list] 微信用户基本信息
+        :param create_unsubscribed: [bool] 是否创建未关注的新用户
+        :return: (创建数, 更新数)
+        """
+        try:
+            infos = {info['openid']: info for info in infos if info.get('openid')}
+            if not infos:
+                return 0, 0
+
+            with db.atomic():
+                wx_users = cls.select().where(cls.wx_authorizer == wx_authorizer, cls.openid << infos.keys())
+                existing, modified, modified_fields = set(), [], set()
+                for wx_user in wx_users:
+                    info = infos[wx_user.openid]
+                    existing.add(wx_user.openid)
+                    wx_user._assign_info(**info)
+                    fields = set(wx_user.modified_fields())
+                    if fields:
+                        wx_user.update_time = datetime.datetime.now()
+                        modified.append(wx_user)
+                        modified_fields |= fields | {'update_time'}
+                if modified:
+                    cls.bulk_update(modified, modified_fields)  # 通过_rows_changed使会话缓存失效
+
+                rows = [dict(cls._info_to_row(**info), wx_authorizer=wx_authorizer)
+                        for openid, info in infos.iteritems()
+                        if openid not in existing and (create_unsubscribed or info.get('subscribe'))]
+                if rows:
+                    # 其他任务可能同时插入了同一用户：按唯一索引(wx_authorizer_id, openid)转为更新（未关注的用户只更新subscribe）
+                    sql, params = cls.insert_many(rows).sql()
+                    updates = ['`subscribe` = VALUES(`subscribe`)', '`update_time` = VALUES(`update_time`)'] + [
+                        '`{0}` = IF(VALUES(`subscribe`), VALUES(`{0}`), `{0}`)'.format(name)
+                        for name in ('unionid', 'nickname', 'sex', 'country', 'province', 'city', 'headimgurl',
+                                     'subscribe_time', 'language', 'remark', 'tagid_list')
+                    ]
+                    cursor = db.execute_sql('%s ON DUPLICATE KEY UPDATE %s' % (sql, ', '.join(updates)), params)
+                    if cursor.rowcount == len(rows):  # 全部是新插入的数据行
+                        cls.count_changed(len(rows))
+                    else:
+                        cls.count_changed()
+                        cls.expire_sessions([_id for _id, in cls.select(cls.id).where(
+                            cls.wx_authorizer == wx_authorizer,
+                            cls.openid << [row['openid'] for row in rows]
+                        ).tuples()])
+            return len(rows), len(modified)
+
+        except Exception, e:
+            current_app.logger.error(e)
+
+    def _assign_info(self, subscribe, unionid=None, nickname=None, sex=None, country=None, province=None, city=None,
+                     headimgurl=None, subscribe_time=None, language=None, remark=None, tagid_list=None, **kwargs):
+        """
+        赋值微信用户基本信息（未关注的用户只更新subscribe）
         :param subscribe:
         :param unionid:
         :param nickname:
@@ -1172,24 +2210,32 @@ class WXUser(BaseModel):
         :param kwargs:
         :return:
         """
+        self.subscribe = subscribe
+        if subscribe:
+            unionid, nickname, country, province, city, headimgurl, language, remark = map(
+                _nullable_strip,
+                (unionid, nickname, country, province, city, headimgurl, language, remark)
+            )
+            self.unionid = unionid
+            self.nickname = nickname
+            self.sex = sex
+            self.country = country
+            self.province = province
+            self.city = city
+            self.headimgurl = headimgurl
+            self.subscribe_time = subscribe_time
+            self.language = language
+            self.remark = remark
+            self.tagid_list = ','.join(map(str, tagid_list)) if tagid_list else None
+
+    def update_wx_user(self, **info):
+        """
+        更新微信用户
+        :param info: 微信用户基本信息，参见_assign_info
+        :return:
+        """
         try:
-            self.subscribe = subscribe
-            if subscribe:
-                unionid, nickname, country, province, city, headimgurl, language, remark = map(
-                    _nullable_strip,
-                    (unionid, nickname, country, province, city, headimgurl, language, remark)
-                )
-                self.unionid = unionid
-                self.nickname = nickname
-                self.sex = sex
-                self.country = country
-                self.province = province
-                self.city = city
-                self.headimgurl = headimgurl
-                self.subscribe_time = subscribe_time
-                self.language = language
-                self.remark = remark
-                self.tagid_list = ','.join(map(str, tagid_list)) if tagid_list else None
+            self._assign_info(**info)
             return self.save_if_modified()
 
         except Exception, e:
@@ -1200,6 +2246,3 @@ class WXUser(BaseModel):
 
     def array_tagid_list(self):
         return map(int, self.tagid_list.split(',')) if self.tagid_list else []
-
-
-models = [Admin, WXAuthorizer, WXUser]
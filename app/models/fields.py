@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import ast
+import json
+
+from peewee import TextField, ForeignKeyField, FieldDescriptor, RelationDescriptor
+
+
+class RawJSON(unicode):
+    """
+    从数据库读出、尚未解码的JSON文本
+    """
+
+    def load(self):
+        """
+        解码
+        :return:
+        """
+        try:
+            return json.loads(self)
+        except ValueError:
+            return ast.literal_eval(self)  # 兼容迁移前以repr()保存的数据
+
+
+class JSONDescriptor(FieldDescriptor):
+    """
+    首次访问时才解码JSON，并将结果缓存在对象中
+    """
+
+    def __get__(self, instance, instance_type=None):
+        if instance is not None:
+            value = instance._data.get(self.att_name)
+            if isinstance(value, RawJSON):
+                value = instance._data[self.att_name] = value.load()
+            return value
+        return self.field
+
+
+class JSONField(TextField):
+    """
+    以JSON文本存储dict/list的字段
+    """
+
+    def _get_descriptor(self):
+        return JSONDescriptor(self)
+
+    def db_value(self, value):
+        if value is None or isinstance(value, RawJSON):
+            return value
+        return json.dumps(value, ensure_ascii=False)
+
+    def python_value(self, value):
+        value = super(JSONField, self).python_value(value)
+        return None if value is None else RawJSON(value)
+
+
+class MappedRelationDescriptor(RelationDescriptor):
+    """
+    访问外键对象时先通过关联model的query_by_id（请求内对象映射）查找，避免同一请求中重复查询
+    """
+
+    def get_object_or_id(self, instance):
+        rel_id = instance._data.get(self.att_name)
+        if rel_id is not None and self.att_name not in instance._obj_cache \
+                and self.field.to_field is self.rel_model._meta.primary_key:
+            obj = self.rel_model.query_by_id(rel_id)
+            if obj is None:
+                raise self.rel_model.DoesNotExist
+            instance._obj_cache[self.att_name] = obj
+        return super(MappedRelationDescriptor, self).get_object_or_id(instance)
+
+
+class MappedForeignKeyField(ForeignKeyField):
+    """
+    通过请求内对象映射访问外键对象的字段
+    """
+
+    def _get_descriptor(self):
+        return MappedRelationDescriptor(self, self.rel_model)
@@ -1,24 +1,246 @@
 # -*- coding: utf-8 -*-
 
+import xml.etree.cElementTree as ElementTree
 import base64
 import hashlib
+import re
 import socket
 import struct
+import threading
 import time
 
-from flask import current_app
 from Crypto.Cipher import AES
 import xmltodict
 
+from utils.aes_util import pad, unpad
 from utils.key_util import generate_random_key
 
 
+_ENCRYPT_RE = re.compile(r'<Encrypt>\s*(?:<!\[CDATA\[(.*?)\]\]>|([^<]*))\s*</Encrypt>', re.S)
+
+
+def extract_encrypt(xml):
+    """
+    从加密消息体中只取出Encrypt字段（不解析整个XML）
+    :param xml:
+    :return:
+    """
+    match = _ENCRYPT_RE.search(xml)
+    if match:
+        return match.group(1) if match.group(1) is not None else match.group(2).strip()
+    return xmltodict.parse(xml)['xml']['Encrypt']
+
+
+_ENCRYPTED_MSG = '<xml><Encrypt><![CDATA[%s]]></Encrypt><MsgSignature><![CDATA[%s]]></MsgSignature>' \
+                 '<TimeStamp>%s</TimeStamp><Nonce><![CDATA[%s]]></Nonce></xml>'
+_REPLY_HEAD = '<xml><ToUserName><![CDATA[%s]]></ToUserName><FromUserName><![CDATA[%s]]></FromUserName>' \
+              '<CreateTime>%d</CreateTime><MsgType><![CDATA[%s]]></MsgType>'
+_REPLY_TEXT = '<Content><![CDATA[%s]]></Content></xml>'
+_REPLY_IMAGE = '<Image><MediaId><![CDATA[%s]]></MediaId></Image></xml>'
+_REPLY_VOICE = '<Voice><MediaId><![CDATA[%s]]></MediaId></Voice></xml>'
+_REPLY_VIDEO = '<Video><MediaId><![CDATA[%s]]></MediaId><Title><![CDATA[%s]]></Title>' \
+               '<Description><![CDATA[%s]]></Description></Video></xml>'
+_REPLY_MUSIC = '<Music><Title><![CDATA[%s]]></Title><Description><![CDATA[%s]]></Description>' \
+               '<MusicUrl><![CDATA[%s]]></MusicUrl><HQMusicUrl><![CDATA[%s]]></HQMusicUrl>' \
+               '<ThumbMediaId><![CDATA[%s]]></ThumbMediaId></Music></xml>'
+_REPLY_NEWS = '<ArticleCount>%d</ArticleCount><Articles>%s</Articles></xml>'
+_REPLY_NEWS_ITEM = '<item><Title><![CDATA[%s]]></Title><Description><![CDATA[%s]]></Description>' \
+                   '<PicUrl><![CDATA[%s]]></PicUrl><Url><![CDATA[%s]]></Url></item>'
+
+
+def _cdata(value):
+    """
+    转换为可放入CDATA段的UTF-8字节串（]]>拆分到两个CDATA段中）
+    :param value:
+    :return:
+    """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace(']]>', ']]]]><![CDATA[>') if ']]>' in value else value
+
+
+def _reply_head(to_user, from_user, msg_type, create_time=None):
+    return _REPLY_HEAD % (_cdata(to_user), _cdata(from_user), create_time or int(time.time()), msg_type)
+
+
+def reply_text(to_user, from_user, content, create_time=None):
+    """
+    被动回复文本消息
+    :param to_user: 接收方openid
+    :param from_user: 公众号原始ID
+    :param content:
+    :param create_time: [int or None]
+    :return: [str] UTF-8编码的XML
+    """
+    return _reply_head(to_user, from_user, 'text', create_time) + _REPLY_TEXT % _cdata(content)
+
+
+def reply_image(to_user, from_user, media_id, create_time=None):
+    """
+    被动回复图片消息
+    :param to_user:
+    :param from_user:
+    :param media_id:
+    :param create_time: [int or None]
+    :return:
+    """
+    return _reply_head(to_user, from_user, 'image', create_time) + _REPLY_IMAGE % _cdata(media_id)
+
+
+def reply_voice(to_user, from_user, media_id, create_time=None):
+    """
+    被动回复语音消息
+    :param to_user:
+    :param from_user:
+    :param media_id:
+    :param create_time: [int or None]
+    :return:
+    """
+    return _reply_head(to_user, from_user, 'voice', create_time) + _REPLY_VOICE % _cdata(media_id)
+
+
+def reply_video(to_user, from_user, media_id, title=None, description=None, create_time=None):
+    """
+    被动回复视频消息
+    :param to_user:
+    :param from_user:
+    :param media_id:
+    :param title:
+    :param description:
+    :param create_time: [int or None]
+    :return:
+    """
+    return _reply_head(to_user, from_user, 'video', create_time) + \
+        _REPLY_VIDEO % (_cdata(media_id), _cdata(title), _cdata(description))
+
+
+def reply_music(to_user, from_user, media_id, title=None, description=None, url=None, hq_url=None,
+                create_time=None):
+    """
+    被动回复音乐消息
+    :param to_user:
+    :param from_user:
+    :param media_id: 缩略图的media_id
+    :param title:
+    :param description:
+    :param url:
+    :param hq_url:
+    :param create_time: [int or None]
+    :return:
+    """
+    return _reply_head(to_user, from_user, 'music', create_time) + \
+        _REPLY_MUSIC % (_cdata(title), _cdata(description), _cdata(url), _cdata(hq_url), _cdata(media_id))
+
+
+def reply_news(to_user, from_user, articles, create_time=None):
+    """
+    被动回复图文消息
+    :param to_user:
+    :param from_user:
+    :param articles: [list] [{'title': ..., 'description': ..., 'pic_url': ..., 'url': ...}]
+    :param create_time: [int or None]
+    :return:
+    """
+    items = ''.join(_REPLY_NEWS_ITEM % tuple(_cdata(item.get(k)) for k in ('title', 'description', 'pic_url', 'url'))
+                    for item in articles)
+    return _reply_head(to_user, from_user, 'news', create_time) + _REPLY_NEWS % (len(articles), items)
+
+
+class WXMessage(object):
+    """
+    解密后的微信消息：首次访问时用cElementTree解析一次，只取<xml>的直接子元素（不会匹配到用户消息内容中的标签），
+    遇到嵌套字段等复杂情况时再用xmltodict解析整个消息
+    """
+
+    def __init__(self, xml):
+        """
+        构造函数
+        :param xml: 解密后的XML文本
+        """
+        self.xml = xml
+        self._values = {}
+        self._elements = None
+        self._dict = None
+
+    def to_dict(self):
+        """
+        用xmltodict解析整个消息
+        :return:
+        """
+        if self._dict is None:
+            self._dict = xmltodict.parse(self.xml)['xml']
+        return self._dict
+
+    def _children(self):
+        """
+        <xml>的直接子元素：标签 -> 元素（同名时取第一个）
+        :return:
+        """
+        if self._elements is None:
+            elements = {}
+            for element in ElementTree.fromstring(self.xml):
+                elements.setdefault(element.tag, element)
+            self._elements = elements
+        return self._elements
+
+    def _lookup(self, key):
+        element = self._children()[key]
+        if len(element) or element.attrib:  # 嵌套字段或带属性的字段
+            return self.to_dict()[key]
+
+        value = (element.text or '').strip()
+        if not value:
+            return  # 与xmltodict一致：空字段为None
+        return value if isinstance(value, unicode) else value.decode('utf-8')
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = self._lookup(key)
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __repr__(self):
+        return 'WXMessage(%r)' % self.xml
+
+
 class WXMsgCrypto(object):
     """
     微信消息加解密
     """
     aes_mode = AES.MODE_CBC
     block_size = 32
+    _instances = {}  # (app_id, token, aes_key) -> 实例
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, wx):
+        """
+        按配置缓存的实例（实例无状态，可在线程间共享），避免每个请求重新解码EncodingAESKey
+        :param wx: [dict]
+        :return:
+        """
+        key = tuple(map(wx.get, ('app_id', 'token', 'aes_key')))
+        crypto = cls._instances.get(key)
+        if crypto is None:
+            with cls._instances_lock:
+                crypto = cls._instances.get(key)
+                if crypto is None:
+                    crypto = cls._instances[key] = cls(wx)
+        return crypto
 
     def __init__(self, wx):
         """
@@ -48,26 +270,18 @@ class WXMsgCrypto(object):
     def encrypt(self, msg):
         """
         消息体加密并打包
-        :param msg:
+        :param msg: [str] UTF-8编码的XML，参见reply_*
         :return:
         """
-        plain_text = generate_random_key(16) + struct.pack('I', socket.htonl(len(msg))) + msg + self.app_id
-        pad_amount = self.block_size - len(plain_text) % self.block_size
-        pad = chr(pad_amount)
-        plain_text += pad * pad_amount
+        plain_text = pad(generate_random_key(16) + struct.pack('I', socket.htonl(len(msg))) + msg + self.app_id,
+                         self.block_size)
         cipher = AES.new(self.aes_key, self.aes_mode, self.aes_iv)
         cipher_text = cipher.encrypt(plain_text)
         msg_encrypt = base64.b64encode(cipher_text)
         timestamp = str(int(time.time()))
         nonce = generate_random_key(16)
         msg_signature = self.generate_sign(timestamp, nonce, msg_encrypt)
-        params = {
-            'msg_encrypt': msg_encrypt,
-            'msg_signature': msg_signature,
-            'timestamp': timestamp,
-            'nonce': nonce
-        }
-        return current_app.jinja_env.get_template('weixin/encrypted_msg.xml').render(**params)
+        return _ENCRYPTED_MSG % (msg_encrypt, msg_signature, timestamp, nonce)
 
     def decrypt(self, xml, msg_signature, timestamp, nonce):
         """
@@ -78,15 +292,12 @@ class WXMsgCrypto(object):
         :param nonce:
         :return:
         """
-        msg_encrypt = xmltodict.parse(xml)['xml']['Encrypt']
+        msg_encrypt = extract_encrypt(xml)
         assert msg_signature == self.generate_sign(timestamp, nonce, msg_encrypt), u'微信消息体签名验证失败'
         cipher = AES.new(self.aes_key, self.aes_mode, self.aes_iv)
         cipher_text = base64.b64decode(msg_encrypt)
-        plain_text = cipher.decrypt(cipher_text)
-        pad = plain_text[-1]
-        pad_amount = ord(pad)
-        content = plain_text[16:-pad_amount]
+        content = unpad(cipher.decrypt(cipher_text))[16:]
         msg_len = socket.ntohl(struct.unpack('I', content[:4])[0])
         msg, app_id = content[4:msg_len + 4], content[msg_len + 4:]
         assert app_id == self.app_id, u'微信AppId验证失败'
-        return xmltodict.parse(msg)['xml']
+        return WXMessage(msg)
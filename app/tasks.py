@@ -1,32 +1,26 @@
 # -*- coding: utf-8 -*-
 
-from celery.signals import task_prerun, task_postrun
+from multiprocessing.pool import ThreadPool
+import time
+
+from flask import current_app
+from celery.signals import task_postrun
 
 from . import db, create_celery_app
+from .models import WXAuthorizer, WXUser
+from .constants import WX_USER_INFO_BATCH_SIZE, WX_USER_SYNC_WINDOW, WX_FOLLOWER_SYNC_MAX_RETRIES, \
+    WX_FOLLOWER_SYNC_RETRY_DELAY
+from utils.redis_util import redis_client, release_lock
+from utils.weixin_util import refresh_component_access_token
 
 
 celery = create_celery_app()
 
 
-@task_prerun.connect()
-def celery_prerun(sender=None, task=None, task_id=None, *args, **kwargs):
-    """
-    celery任务执行前钩子函数
-    :param sender:
-    :param task:
-    :param task_id:
-    :param args:
-    :param kwargs:
-    :return:
-    """
-    if db.is_closed():
-        db.connect()
-
-
 @task_postrun.connect()
 def celery_postrun(sender=None, task=None, task_id=None, retval=None, state=None, *args, **kwargs):
     """
-    celery任务执行后钩子函数
+    celery任务执行后钩子函数（数据库连接在首次查询时才从连接池取出）
     :param sender:
     :param task:
     :param task_id:
@@ -37,7 +31,7 @@ def celery_postrun(sender=None, task=None, task_id=None, retval=None, state=None
     :return:
     """
     if not db.is_closed():
-        db.close()
+        db.close()  # 放回连接池
 
 
 @celery.task()
@@ -54,3 +48,184 @@ def for_release_testing(wx_authorizer, openid, query_auth_code):
         'content': query_auth_code + '_from_api'
     }
     wx_authorizer.send_custom_message(openid, msg_type, msg_data)
+
+
+@celery.task()
+def refresh_component_token():
+    """
+    （定时任务）提前刷新微信第三方平台component_access_token
+    :return:
+    """
+    refresh_component_access_token(current_app.config['WEIXIN'])
+
+
+@celery.task()
+def refresh_authorizer_tokens(batch_size=100):
+    """
+    （定时任务）分批提前刷新全部已授权微信授权方的接口调用凭证
+    :param batch_size:
+    :return:
+    """
+    last_id = 0
+    while True:
+        select_query = WXAuthorizer.select(WXAuthorizer.id).where(
+            WXAuthorizer.authorized == True,
+            WXAuthorizer.id > last_id
+        ).order_by(WXAuthorizer.id).limit(batch_size)
+        ids = [_id for _id, in select_query.tuples()]
+        if not ids:
+            break
+
+        refresh_authorizer_tokens_batch.delay(ids)  # celery task
+        last_id = ids[-1]
+
+
+@celery.task()
+def refresh_authorizer_tokens_batch(ids):
+    """
+    提前刷新一批微信授权方的接口调用凭证
+    :param ids:
+    :return:
+    """
+    for wx_authorizer in WXAuthorizer.select().where(WXAuthorizer.id << ids):
+        wx_authorizer.refresh_tokens()
+
+
+def enqueue_wx_user_sync(wx_authorizer_id, openid, force=False):
+    """
+    将微信用户基本信息同步加入队列（每隔一天同步一次，同一用户同时只排队一次）；
+    同一微信授权方在合并窗口内排队的用户由一个任务批量同步
+    :param wx_authorizer_id:
+    :param openid:
+    :param force: [bool] 忽略每天一次的限制
+    :return:
+    """
+    info_key = 'wx_user:%s:%s:info' % (wx_authorizer_id, openid)
+    sync_key = 'wx_user:%s:%s:syncing' % (wx_authorizer_id, openid)
+    if force:
+        if not redis_client.set(sync_key, 1, ex=60, nx=True):
+            return
+        redis_client.set(info_key, 'off', ex=86400)
+    else:
+        if not redis_client.set(info_key, 'off', ex=86400, nx=True):
+            return
+        redis_client.set(sync_key, 1, ex=60)
+
+    queue_key = 'wx_user:%s:sync_queue' % wx_authorizer_id
+    redis_client.sadd(queue_key, openid)
+    if redis_client.set('%s:scheduled' % queue_key, 1, ex=60, nx=True):
+        sync_wx_users_info.apply_async((wx_authorizer_id,), countdown=WX_USER_SYNC_WINDOW)  # celery task
+
+
+@celery.task()
+def sync_wx_users_info(wx_authorizer_id):
+    """
+    批量同步排队中的微信用户基本信息
+    :param wx_authorizer_id:
+    :return:
+    """
+    queue_key = 'wx_user:%s:sync_queue' % wx_authorizer_id
+    redis_client.delete('%s:scheduled' % queue_key)  # 此后加入队列的用户由下一个任务同步
+    pipe = redis_client.pipeline()
+    pipe.smembers(queue_key)
+    pipe.delete(queue_key)
+    openids = list(pipe.execute()[0])
+    if not openids:
+        return
+
+    try:
+        wx_authorizer = WXAuthorizer.query_by_id(wx_authorizer_id)
+        if not wx_authorizer:
+            return
+
+        infos = wx_authorizer.get_users_info(openids)
+        if not infos:
+            current_app.logger.error(u'微信用户基本信息获取失败')
+            return
+
+        WXUser.bulk_sync_wx_users(wx_authorizer, infos, create_unsubscribed=False)  # 取消关注的未知用户不创建
+    finally:
+        redis_client.delete(*['wx_user:%s:%s:syncing' % (wx_authorizer_id, openid) for openid in openids])
+
+
+@celery.task(bind=True, max_retries=WX_FOLLOWER_SYNC_MAX_RETRIES)
+def sync_wx_followers(self, wx_authorizer_id, next_openid=None, concurrency=None):
+    """
+    全量同步微信授权方的关注者：每个任务同步一页（最多10000个openid）并记录断点，完成后排队下一页；
+    任一批失败时整页失败，断点不前进，按指数退避重试该页并在断点中记录错误
+    :param wx_authorizer_id:
+    :param next_openid: 为None时从断点继续（上次已完成则从头开始）
+    :param concurrency: 批量获取微信用户基本信息的并发数
+    :return:
+    """
+    checkpoint_key = 'wx_user:%s:follower_sync' % wx_authorizer_id
+    lock = redis_client.lock('%s:lock' % checkpoint_key, timeout=600)
+    if not lock.acquire(blocking=False):  # 同一微信授权方同时只同步一页
+        return
+
+    error, openids = None, None
+    try:
+        wx_authorizer = WXAuthorizer.query_by_id(wx_authorizer_id)
+        if not wx_authorizer:
+            return
+
+        if next_openid is None:
+            status, next_openid = redis_client.hmget(checkpoint_key, 'status', 'next_openid')
+            if status not in ('running', 'failed'):
+                next_openid = ''
+                redis_client.hmset(checkpoint_key, {'status': 'running', 'next_openid': '', 'synced': 0})
+
+        result = wx_authorizer.get_followers(next_openid) if wx_authorizer.get_access_token() else None
+        if result is None:
+            error = u'微信关注者列表获取失败'
+        else:
+            total, openids, next_openid = result
+            app = current_app._get_current_object()
+
+            def _get_users_info(batch):
+                try:
+                    with app.app_context():
+                        return wx_authorizer.get_users_info(batch)
+                finally:
+                    # 令牌未命中缓存时工作线程会从连接池取出连接（刷新并保存授权方令牌），用完放回连接池
+                    if not db.is_closed():
+                        db.close()
+
+            batches = [openids[i:i + WX_USER_INFO_BATCH_SIZE] for i in range(0, len(openids), WX_USER_INFO_BATCH_SIZE)]
+            pool = ThreadPool(concurrency or current_app.config['WX_FOLLOWER_SYNC_CONCURRENCY'])
+            try:
+                for infos in pool.imap_unordered(_get_users_info, batches):
+                    if infos is None or (infos and WXUser.bulk_sync_wx_users(wx_authorizer, infos) is None):
+                        error = u'微信用户基本信息同步失败'
+                    elif infos:
+                        redis_client.hincrby(checkpoint_key, 'synced', len(infos))
+            finally:
+                pool.close()
+                pool.join()
+
+        if error:
+            current_app.logger.error(error)
+            exhausted = self.request.retries >= self.max_retries
+            redis_client.hmset(checkpoint_key, {
+                'status': 'failed' if exhausted else 'running',
+                'error': error,
+                'retries': self.request.retries,
+                'update_time': int(time.time())
+            })
+            if exhausted:
+                return
+        else:
+            redis_client.hdel(checkpoint_key, 'error', 'retries')
+            redis_client.hmset(checkpoint_key, {
+                'status': 'running' if openids and next_openid else 'done',
+                'next_openid': next_openid or '',
+                'total': total or 0,
+                'update_time': int(time.time())
+            })
+    finally:
+        release_lock(lock)
+
+    if error:  # 断点未前进，稍后重试同一页
+        raise self.retry(countdown=min(WX_FOLLOWER_SYNC_RETRY_DELAY * 2 ** self.request.retries, 3600))
+    if openids and next_openid:
+        sync_wx_followers.delay(wx_authorizer_id, next_openid, concurrency)  # celery task
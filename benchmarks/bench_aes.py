@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+AES加解密微基准测试：对比改造前（每次拼接填充串）与改造后（预生成填充串 & 批量接口）的单次耗时
+
+    python benchmarks/bench_aes.py [次数]
+"""
+
+import os
+import sys
+import base64
+import hashlib
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('AES_KEY_SEED', 'benchmark')
+
+from Crypto.Cipher import AES
+
+from utils import aes_util
+from utils.aes_util import encrypt, decrypt, encrypt_many, decrypt_many, pad, unpad
+
+
+_KEY, _MODE, _IV = aes_util._KEY, aes_util._MODE, aes_util._IV
+_WX_KEY = base64.b64decode('abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG' + '=')  # 示例EncodingAESKey
+_WX_IV = _WX_KEY[:16]
+_WX_BLOCK_SIZE = 32
+
+
+def legacy_encrypt(text, key=_KEY, iv=_IV, block_size=AES.block_size):
+    cipher = AES.new(key, _MODE, iv)
+    pad_amount = block_size - len(text) % block_size
+    text += chr(pad_amount) * pad_amount
+    return base64.b64encode(cipher.encrypt(text))
+
+
+def legacy_decrypt(text, key=_KEY, iv=_IV):
+    cipher = AES.new(key, _MODE, iv)
+    plain_text = cipher.decrypt(base64.b64decode(text))
+    return plain_text[:-ord(plain_text[-1])]
+
+
+def wx_encrypt(text):
+    return base64.b64encode(AES.new(_WX_KEY, _MODE, _WX_IV).encrypt(pad(text, _WX_BLOCK_SIZE)))
+
+
+def wx_decrypt(text):
+    return unpad(AES.new(_WX_KEY, _MODE, _WX_IV).decrypt(base64.b64decode(text)))
+
+
+def bench(name, func, number, items=1):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print '%-36s %8.2f us/call' % (name, seconds / number / items * 1e6)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cookie = hashlib.md5('wx_user').hexdigest()  # 与微信用户cookie中的uuid.hex等长
+    token = 'admin:1:%s:0' % 1500000000
+    wx_msg = 'x' * 16 + '\x00\x00\x01\x00' + '<xml>' + 'y' * 240 + '</xml>' + 'wx0000000000000000'
+    batch = [cookie] * 100
+
+    assert decrypt(encrypt(cookie)) == legacy_decrypt(legacy_encrypt(cookie)) == cookie
+    assert encrypt(token) == legacy_encrypt(token)
+    assert decrypt_many(encrypt_many(batch)) == batch
+    assert wx_decrypt(wx_encrypt(wx_msg)) == wx_msg
+    assert wx_encrypt(wx_msg) == legacy_encrypt(wx_msg, _WX_KEY, _WX_IV, _WX_BLOCK_SIZE)
+
+    cipher_cookie, cipher_token = encrypt(cookie), encrypt(token)
+    cipher_wx, cipher_batch = wx_encrypt(wx_msg), encrypt_many(batch)
+
+    print 'module key (AES_KEY_SEED)'
+    bench('  encrypt cookie (before)', lambda: legacy_encrypt(cookie), number)
+    bench('  encrypt cookie (after)', lambda: encrypt(cookie), number)
+    bench('  decrypt cookie (before)', lambda: legacy_decrypt(cipher_cookie), number)
+    bench('  decrypt cookie (after)', lambda: decrypt(cipher_cookie), number)
+    bench('  decrypt admin token (before)', lambda: legacy_decrypt(cipher_token), number)
+    bench('  decrypt admin token (after)', lambda: decrypt(cipher_token), number)
+    bench('  encrypt_many x100 (per item)', lambda: encrypt_many(batch), number / 100 or 1, 100)
+    bench('  decrypt_many x100 (per item)', lambda: decrypt_many(cipher_batch), number / 100 or 1, 100)
+
+    print 'WXMsgCrypto key (EncodingAESKey, 32-byte blocks)'
+    bench('  encrypt message (before)', lambda: legacy_encrypt(wx_msg, _WX_KEY, _WX_IV, _WX_BLOCK_SIZE), number)
+    bench('  encrypt message (after)', lambda: wx_encrypt(wx_msg), number)
+    bench('  decrypt message (before)', lambda: legacy_decrypt(cipher_wx, _WX_KEY, _WX_IV), number)
+    bench('  decrypt message (after)', lambda: wx_decrypt(cipher_wx), number)
+
+
+if __name__ == '__main__':
+    main()
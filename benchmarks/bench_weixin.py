@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+微信消息解密 & 解析微基准测试：对比改造前（每个请求新建WXMsgCrypto、xmltodict解析两次）与改造后的单次耗时
+样例消息为按微信文档格式构造的文本消息、关注事件和component_verify_ticket推送
+
+    python benchmarks/bench_weixin.py [次数]
+"""
+
+import os
+import sys
+import imp
+import base64
+import socket
+import struct
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('AES_KEY_SEED', 'benchmark')
+
+from Crypto.Cipher import AES
+import xmltodict
+
+from utils.aes_util import pad, unpad
+
+# 直接加载模块，避免导入app包时初始化数据库等
+weixin = imp.load_source('_bench_weixin', os.path.join(ROOT, 'app', 'services', 'weixin.py'))
+WXMsgCrypto = weixin.WXMsgCrypto
+
+WX = {
+    'app_id': 'wx0000000000000000',
+    'token': 'benchmark_token',
+    'aes_key': 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+}
+TIMESTAMP, NONCE = '1500000000', '1234567890'
+
+SAMPLES = {
+    'text': '<xml><ToUserName><![CDATA[gh_0000000000]]></ToUserName>'
+            '<FromUserName><![CDATA[oABCD0000000000000000000000]]></FromUserName>'
+            '<CreateTime>1500000000</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+            '<Content><![CDATA[%s]]></Content><MsgId>6400000000000000000</MsgId></xml>' % ('你好' * 20),
+    'event': '<xml><ToUserName><![CDATA[gh_0000000000]]></ToUserName>'
+             '<FromUserName><![CDATA[oABCD0000000000000000000000]]></FromUserName>'
+             '<CreateTime>1500000000</CreateTime><MsgType><![CDATA[event]]></MsgType>'
+             '<Event><![CDATA[subscribe]]></Event><EventKey><![CDATA[qrscene_123]]></EventKey>'
+             '<Ticket><![CDATA[TICKET0000000000000000000000000000000000000000]]></Ticket></xml>',
+    'component_verify_ticket': '<xml><AppId><![CDATA[wx0000000000000000]]></AppId>'
+                               '<CreateTime>1500000000</CreateTime>'
+                               '<InfoType><![CDATA[component_verify_ticket]]></InfoType>'
+                               '<ComponentVerifyTicket><![CDATA[ticket@@@%s]]></ComponentVerifyTicket></xml>'
+                               % ('x' * 80)
+}
+# 用户消息内容中包含标签样式的文本，不应被当作消息字段
+SPOOFED = '<xml><ToUserName><![CDATA[gh_0000000000]]></ToUserName>' \
+          '<FromUserName><![CDATA[oABCD0000000000000000000000]]></FromUserName>' \
+          '<CreateTime>1500000000</CreateTime><MsgType><![CDATA[text]]></MsgType>' \
+          '<Content><![CDATA[<MsgId>1</MsgId> <Event>subscribe</Event> ]]]]><![CDATA[>]]></Content>' \
+          '<MsgId>6400000000000000000</MsgId></xml>'
+FIELDS = {
+    'text': ('FromUserName', 'MsgType', 'Event', 'Content'),
+    'event': ('FromUserName', 'MsgType', 'Event'),
+    'component_verify_ticket': ('AppId', 'InfoType', 'ComponentVerifyTicket')
+}
+
+
+def envelope(crypto, msg):
+    """
+    按微信的方式加密并打包消息
+    """
+    plain_text = pad('0123456789abcdef' + struct.pack('I', socket.htonl(len(msg))) + msg + crypto.app_id,
+                     crypto.block_size)
+    msg_encrypt = base64.b64encode(AES.new(crypto.aes_key, crypto.aes_mode, crypto.aes_iv).encrypt(plain_text))
+    xml = '<xml><ToUserName><![CDATA[gh_0000000000]]></ToUserName><Encrypt><![CDATA[%s]]></Encrypt></xml>' \
+          % msg_encrypt
+    return xml, crypto.generate_sign(TIMESTAMP, NONCE, msg_encrypt)
+
+
+def legacy_decrypt(wx, xml, msg_signature, timestamp, nonce):
+    crypto = WXMsgCrypto(wx)
+    msg_encrypt = xmltodict.parse(xml)['xml']['Encrypt']
+    assert msg_signature == crypto.generate_sign(timestamp, nonce, msg_encrypt)
+    cipher = AES.new(crypto.aes_key, crypto.aes_mode, crypto.aes_iv)
+    plain_text = cipher.decrypt(base64.b64decode(msg_encrypt))
+    content = unpad(plain_text)[16:]
+    msg_len = socket.ntohl(struct.unpack('I', content[:4])[0])
+    msg, app_id = content[4:msg_len + 4], content[msg_len + 4:]
+    assert app_id == crypto.app_id
+    return xmltodict.parse(msg)['xml']
+
+
+def current_decrypt(wx, xml, msg_signature, timestamp, nonce):
+    return WXMsgCrypto.from_config(wx).decrypt(xml, msg_signature, timestamp, nonce)
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print '%-44s %8.2f us/call' % (name, seconds / number * 1e6)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    crypto = WXMsgCrypto.from_config(WX)
+    xml, signature = envelope(crypto, SPOOFED)
+    legacy = legacy_decrypt(WX, xml, signature, TIMESTAMP, NONCE)
+    current = current_decrypt(WX, xml, signature, TIMESTAMP, NONCE)
+    fields = ('MsgId', 'Event', 'Content', 'FromUserName')
+    assert map(legacy.get, fields) == map(current.get, fields), 'spoofed'
+    assert current['MsgId'] == '6400000000000000000' and current.get('Event') is None, 'spoofed'
+
+    for name, msg in sorted(SAMPLES.items()):
+        xml, signature = envelope(crypto, msg)
+        fields = FIELDS[name]
+        legacy = legacy_decrypt(WX, xml, signature, TIMESTAMP, NONCE)
+        current = current_decrypt(WX, xml, signature, TIMESTAMP, NONCE)
+        assert map(legacy.get, fields) == map(current.get, fields), name
+
+        print '%s (%d bytes)' % (name, len(xml))
+        bench('  decrypt + read fields (before)',
+              lambda: map(legacy_decrypt(WX, xml, signature, TIMESTAMP, NONCE).get, fields), number)
+        bench('  decrypt + read fields (after)',
+              lambda: map(current_decrypt(WX, xml, signature, TIMESTAMP, NONCE).get, fields), number)
+        bench('  extract Encrypt (xmltodict)', lambda: xmltodict.parse(xml)['xml']['Encrypt'], number)
+        bench('  extract Encrypt (regex)', lambda: weixin.extract_encrypt(xml), number)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,11 @@ class Config(object):
         'port': int(environ.get('FLASK_MYSQL_PORT') or 3306),
         'user': environ.get('FLASK_MYSQL_USER'),
         'password': environ.get('FLASK_MYSQL_PASSWORD'),
-        'database': environ.get('FLASK_MYSQL_DB') or _project_name.replace('-', '_')
+        'database': environ.get('FLASK_MYSQL_DB') or _project_name.replace('-', '_'),
+        'max_connections': int(environ.get('FLASK_MYSQL_MAX_CONNECTIONS') or 20),  # 连接池最大连接数
+        'stale_timeout': int(environ.get('FLASK_MYSQL_STALE_TIMEOUT') or 300),  # 连接创建后超过该时间（秒）不再复用
+        'wait_timeout': float(environ.get('FLASK_MYSQL_WAIT_TIMEOUT') or 3),  # 连接数达到上限时的最长等待时间（秒）
+        'ping_interval': int(environ.get('FLASK_MYSQL_PING_INTERVAL') or 30)  # 连接空闲超过该时间（秒）后取出时做健康检查
     }
 
     # celery
@@ -34,6 +38,16 @@ class Config(object):
     CELERY_TASK_SERIALIZER = 'pickle'
     CELERY_RESULT_SERIALIZER = 'pickle'
     CELERY_TIMEZONE = 'Asia/Shanghai'
+    CELERYBEAT_SCHEDULE = {
+        'refresh_component_token': {
+            'task': 'app.tasks.refresh_component_token',
+            'schedule': 60
+        },
+        'refresh_authorizer_tokens': {
+            'task': 'app.tasks.refresh_authorizer_tokens',
+            'schedule': 60
+        }
+    }
 
     # 七牛
     QINIU = {
@@ -56,10 +70,14 @@ class Config(object):
         'app_secret': environ.get('WEIXIN_APP_SECRET'),
         'token': environ.get('WEIXIN_TOKEN'),
         'aes_key': environ.get('WEIXIN_AES_KEY'),
+        'token_sync_refresh': (environ.get('WEIXIN_TOKEN_SYNC_REFRESH') or 'on') == 'on',  # 凭证未命中时是否同步刷新
         'auth_error_page': environ.get('WEIXIN_AUTH_ERROR_PAGE') or '/',
         'auth_success_page': environ.get('WEIXIN_AUTH_SUCCESS_PAGE') or '/'
     }
 
+    # 微信关注者全量同步时每个微信授权方的并发请求数
+    WX_FOLLOWER_SYNC_CONCURRENCY = int(environ.get('WX_FOLLOWER_SYNC_CONCURRENCY') or 4)
+
     # 微信授权方公众号appid
     SAMPLE_APPID = 'wx0000000000000000'
 
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+from app import create_app, db
+from app.migrations import MIGRATIONS, applied_versions, upgrade
+
+
+def main(argv):
+    """
+    数据库迁移命令
+        python migrate.py upgrade [version]  执行未执行的迁移
+        python migrate.py status             查看迁移状态
+    :param argv:
+    :return:
+    """
+    create_app(os.getenv('FLASK_CONFIG') or 'default')
+    command = argv[1] if len(argv) > 1 else 'upgrade'
+    try:
+        if command == 'upgrade':
+            done = upgrade(int(argv[2]) if len(argv) > 2 else None)
+            print 'applied: %s' % (', '.join(map(str, done)) or 'none')
+        elif command == 'status':
+            applied = applied_versions()
+            for version, description, f in sorted(MIGRATIONS):
+                print '[%s] %04d %s' % ('x' if version in applied else ' ', version, description.encode('utf-8'))
+        else:
+            print main.__doc__
+            return 1
+    finally:
+        if not db.is_closed():
+            db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
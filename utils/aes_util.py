@@ -10,6 +10,38 @@ from Crypto.Cipher import AES
 _KEY = hashlib.md5(os.getenv('AES_KEY_SEED')).hexdigest()
 _MODE = AES.MODE_CBC
 _IV = _KEY[:AES.block_size]
+_PADS = {}  # block_size -> 预先生成的填充串（CBC模式的cipher对象有状态，不能复用，只缓存密钥参数和填充串）
+
+
+def _pads(block_size):
+    """
+    各填充长度对应的填充串
+    :param block_size:
+    :return:
+    """
+    pads = _PADS.get(block_size)
+    if pads is None:
+        pads = _PADS[block_size] = [chr(n) * n for n in range(block_size + 1)]
+    return pads
+
+
+def pad(text, block_size=AES.block_size):
+    """
+    PKCS#7填充
+    :param text:
+    :param block_size:
+    :return:
+    """
+    return text + _pads(block_size)[block_size - len(text) % block_size]
+
+
+def unpad(text):
+    """
+    去除PKCS#7填充
+    :param text:
+    :return:
+    """
+    return text[:-ord(text[-1])]
 
 
 def encrypt(text):
@@ -18,12 +50,7 @@ def encrypt(text):
     :param text:
     :return:
     """
-    cipher = AES.new(_KEY, _MODE, _IV)
-    pad_amount = AES.block_size - len(text) % AES.block_size
-    pad = chr(pad_amount)
-    text += pad * pad_amount
-    cipher_text = cipher.encrypt(text)
-    return base64.b64encode(cipher_text)
+    return base64.b64encode(AES.new(_KEY, _MODE, _IV).encrypt(pad(text)))
 
 
 def decrypt(text):
@@ -32,9 +59,25 @@ def decrypt(text):
     :param text:
     :return:
     """
-    cipher = AES.new(_KEY, _MODE, _IV)
-    cipher_text = base64.b64decode(text)
-    plain_text = cipher.decrypt(cipher_text)
-    pad = plain_text[-1]
-    pad_amount = ord(pad)
-    return plain_text[:-pad_amount]
+    return unpad(AES.new(_KEY, _MODE, _IV).decrypt(base64.b64decode(text)))
+
+
+def encrypt_many(texts):
+    """
+    批量AES加密 & BASE64编码
+    :param texts: [iterable]
+    :return: [list]
+    """
+    new, b64encode, pads, block_size = AES.new, base64.b64encode, _pads(AES.block_size), AES.block_size
+    return [b64encode(new(_KEY, _MODE, _IV).encrypt(text + pads[block_size - len(text) % block_size]))
+            for text in texts]
+
+
+def decrypt_many(texts):
+    """
+    批量BASE64解码 & AES解密
+    :param texts: [iterable]
+    :return: [list]
+    """
+    new, b64decode = AES.new, base64.b64decode
+    return [unpad(new(_KEY, _MODE, _IV).decrypt(b64decode(text))) for text in texts]
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from peewee import savepoint
+from playhouse.pool import PooledMySQLDatabase, MaxConnectionsExceeded
+
+
+class _Savepoint(savepoint):
+    """
+    回滚到保存点时同时丢弃保存点之后注册的事务提交后回调
+    """
+
+    def __enter__(self):
+        self._callbacks_mark = len(self.db._pending_callbacks())
+        return super(_Savepoint, self).__enter__()
+
+    def rollback(self):
+        super(_Savepoint, self).rollback()
+        del self.db._pending_callbacks()[self._callbacks_mark:]
+
+
+class MonitoredPooledMySQLDatabase(PooledMySQLDatabase):
+    """
+    MySQL连接池：连接数达到上限时短暂等待，空闲超过一定时间的连接取出时才做健康检查，并记录统计信息；
+    支持事务提交后回调（on_commit）
+    """
+
+    def __init__(self, database, wait_timeout=3, ping_interval=30, **kwargs):
+        """
+        构造函数
+        :param database:
+        :param wait_timeout: 连接数达到上限时的最长等待时间（秒）
+        :param ping_interval: 连接空闲超过该时间（秒）后，取出时ping检查连接是否可用
+        :param kwargs: max_connections, stale_timeout及数据库连接参数
+        """
+        self.wait_timeout = wait_timeout
+        self.ping_interval = ping_interval
+        self._released = {}  # 连接key -> 最近放回连接池的时间
+        self._stats_lock = threading.Lock()
+        self._commit_callbacks = threading.local()  # 当前线程的事务提交后回调
+        self._stats = {'connects': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait_time': 0.0, 'timeouts': 0}
+        super(MonitoredPooledMySQLDatabase, self).__init__(database, **kwargs)
+
+    def init(self, database, max_connections=None, stale_timeout=None, wait_timeout=None, ping_interval=None,
+             **connect_kwargs):
+        """
+        延迟初始化
+        :param database:
+        :param max_connections:
+        :param stale_timeout:
+        :param wait_timeout:
+        :param ping_interval:
+        :param connect_kwargs:
+        :return:
+        """
+        super(MonitoredPooledMySQLDatabase, self).init(database, **connect_kwargs)
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if stale_timeout is not None:
+            self.stale_timeout = stale_timeout
+        if wait_timeout is not None:
+            self.wait_timeout = wait_timeout
+        if ping_interval is not None:
+            self.ping_interval = ping_interval
+
+    def connect(self):
+        """
+        从连接池取出连接；连接数达到上限时在锁外轮询等待
+        :return:
+        """
+        start = time.time()
+        while True:
+            try:
+                super(MonitoredPooledMySQLDatabase, self).connect()
+                break
+            except MaxConnectionsExceeded:
+                if time.time() - start >= self.wait_timeout:
+                    with self._stats_lock:
+                        self._stats['timeouts'] += 1
+                    raise
+                time.sleep(0.01)
+
+        wait_time = time.time() - start
+        with self._stats_lock:
+            self._stats['connects'] += 1
+            if wait_time >= 0.01:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += wait_time
+                self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+
+    def on_commit(self, callback):
+        """
+        在当前事务提交后执行回调（如使缓存失效），事务回滚时丢弃；不在事务中时立即执行
+        :param callback: 无参数的函数
+        :return:
+        """
+        if self.transaction_depth() == 0:
+            callback()
+            return
+
+        self._pending_callbacks().append(callback)
+
+    def _pending_callbacks(self):
+        """
+        当前线程待执行的事务提交后回调
+        :return: [list]
+        """
+        callbacks = getattr(self._commit_callbacks, 'callbacks', None)
+        if callbacks is None:
+            callbacks = self._commit_callbacks.callbacks = []
+        return callbacks
+
+    def savepoint(self, sid=None):
+        return _Savepoint(self, sid)
+
+    def commit(self):
+        super(MonitoredPooledMySQLDatabase, self).commit()
+        if self.transaction_depth() <= 1:  # 最外层事务提交（或自动提交）
+            callbacks, self._commit_callbacks.callbacks = getattr(self._commit_callbacks, 'callbacks', None), None
+            for callback in callbacks or []:
+                callback()
+
+    def rollback(self):
+        super(MonitoredPooledMySQLDatabase, self).rollback()
+        if self.transaction_depth() <= 1:
+            self._commit_callbacks.callbacks = None
+
+    def _is_closed(self, key, conn):
+        """
+        最近刚放回连接池的连接跳过ping
+        :param key:
+        :param conn:
+        :return:
+        """
+        if time.time() - self._released.get(key, 0) < self.ping_interval:
+            return False
+
+        closed = super(MonitoredPooledMySQLDatabase, self)._is_closed(key, conn)
+        if closed:  # 连接池会丢弃该连接
+            self._released.pop(key, None)
+        return closed
+
+    def _close(self, conn, close_conn=False):
+        key = self.conn_key(conn)
+        super(MonitoredPooledMySQLDatabase, self)._close(conn, close_conn)
+        if not close_conn and any(self.conn_key(pooled) == key for _, pooled in self._connections):
+            self._released[key] = time.time()
+        else:  # 连接已关闭（包括超过stale_timeout被连接池关闭的连接），不再记录
+            self._released.pop(key, None)
+
+    def stats(self):
+        """
+        连接池统计信息
+        :return:
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({
+            'max_connections': self.max_connections,
+            'in_use': len(self._in_use),
+            'idle': len(self._connections),
+            'avg_wait_time': stats['wait_time'] / stats['waits'] if stats['waits'] else 0.0
+        })
+        return stats
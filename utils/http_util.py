@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS') or 10)  # 缓存的连接池数量（按host区分）
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE') or 20)  # 每个连接池保持的最大连接数
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES') or 1)  # 建立连接失败时的重试次数
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT') or 3.05)  # 连接超时（秒）
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT') or 10)  # 读取超时（秒）
+
+
+class HTTPClient(object):
+    """
+    进程内共享的HTTP客户端（连接池 & keep-alive）
+    """
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        """
+        构造函数
+        :param pool_connections:
+        :param pool_maxsize:
+        :param max_retries:
+        :param timeout: [tuple] (连接超时, 读取超时)
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _create_session(self):
+        """
+        创建带连接池的会话
+        :return:
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                              max_retries=self.max_retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """
+        当前进程的会话；gunicorn/celery fork出子进程后重新创建，避免父子进程共用socket
+        :return:
+        """
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    self._session = self._create_session()
+                    self._pid = pid
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """
+        发送请求
+        :param method:
+        :param url:
+        :param kwargs:
+        :return:
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+http_client = HTTPClient()
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+import cPickle
+import hashlib
+import hmac
 import os
+import time
+import threading
 
 from redis import StrictRedis
+from redis.exceptions import LockError
 
 
 redis_client = StrictRedis(
@@ -10,3 +17,339 @@ redis_client = StrictRedis(
     port=int(os.getenv('REDIS_PORT') or 6379),
     db=int(os.getenv('REDIS_DB') or 0)
 )
+
+LOCAL_CACHE_MAX_SIZE = int(os.getenv('LOCAL_CACHE_MAX_SIZE') or 1024)  # 进程内缓存的最大条目数
+LOCAL_CACHE_MAX_TTL = float(os.getenv('LOCAL_CACHE_MAX_TTL') or 60)  # 进程内缓存的最长有效期（秒）
+LOCAL_CACHE_CHANNEL = 'local_cache:invalidate'  # 进程内缓存失效通知的频道
+CACHE_SIGNING_KEY = os.getenv('CACHE_SIGNING_KEY')  # 缓存中pickle数据的签名密钥，未设置时不缓存对象
+
+
+class LocalCache(object):
+    """
+    进程内TTL缓存（LRU淘汰），通过redis pub/sub接收失效通知
+    """
+
+    def __init__(self, max_size=LOCAL_CACHE_MAX_SIZE, max_ttl=LOCAL_CACHE_MAX_TTL, channel=LOCAL_CACHE_CHANNEL):
+        """
+        构造函数
+        :param max_size:
+        :param max_ttl:
+        :param channel:
+        """
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.channel = channel
+        self.generation = 0  # 每次失效加1，用于丢弃失效前读到的旧值
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+        self._subscribed = threading.Event()
+        self._pid = None
+
+    def _ensure_listener(self):
+        """
+        确保当前进程已启动订阅线程；fork出的子进程清空继承的缓存并重新订阅
+        :return:
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            self._pid = pid
+            self._subscribed = threading.Event()
+            self.clear()
+            listener = threading.Thread(target=self._listen, args=(self._subscribed,), name='local-cache-listener')
+            listener.daemon = True
+            listener.start()
+
+    def _listen(self, subscribed):
+        """
+        订阅失效通知；连接断开期间不使用进程内缓存，重连后清空
+        :param subscribed: [threading.Event]
+        :return:
+        """
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.clear()
+                subscribed.set()
+                for message in pubsub.listen():
+                    key = message['data']
+                    if key.endswith('*'):
+                        self.delete_prefix(key[:-1])
+                    else:
+                        self.delete(key)
+            except Exception:
+                subscribed.clear()
+                self.clear()
+                time.sleep(1)
+
+    def get(self, key):
+        """
+        读取缓存
+        :param key:
+        :return: 未命中时返回None
+        """
+        self._ensure_listener()
+        if not self._subscribed.is_set():
+            return
+
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return
+
+            value, expires = item
+            if expires <= time.time():
+                return
+
+            self._items[key] = item  # 移到末尾（最近使用）
+            return value
+
+    def set(self, key, value, ttl, generation=None):
+        """
+        写入缓存
+        :param key:
+        :param value:
+        :param ttl: 有效期（秒），不超过max_ttl
+        :param generation: 读取value前的generation，期间发生过失效则放弃写入
+        :return:
+        """
+        self._ensure_listener()
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time() + min(ttl, self.max_ttl))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self.generation += 1
+            self._items.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            self.generation += 1
+            for key in [k for k in self._items if k.startswith(prefix)]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+
+local_cache = LocalCache()
+
+
+def cached_get(key):
+    """
+    先读进程内缓存，未命中再读redis，并按redis中的剩余有效期缓存到进程内
+    :param key:
+    :return:
+    """
+    value = local_cache.get(key)
+    if value is not None:
+        return value
+
+    generation = local_cache.generation
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(key)
+    pipe.pttl(key)
+    value, pttl = pipe.execute()
+    if value is not None and pttl != -2:
+        local_cache.set(key, value, local_cache.max_ttl if pttl == -1 else pttl / 1000.0, generation)
+    return value
+
+
+def cached_set(key, value, ex=None):
+    """
+    写入redis并通知所有进程的进程内缓存失效
+    :param key:
+    :param value:
+    :param ex:
+    :return:
+    """
+    redis_client.set(key, value, ex=ex)
+    invalidate(key)
+
+
+def invalidate(*keys):
+    """
+    通知所有进程的进程内缓存失效；以*结尾的key按前缀失效
+    :param keys:
+    :return:
+    """
+    for key in keys:
+        if key.endswith('*'):
+            local_cache.delete_prefix(key[:-1])
+        else:
+            local_cache.delete(key)
+        redis_client.publish(LOCAL_CACHE_CHANNEL, key)
+
+
+def set_indexed(key, value, ex, index_key, index_ex=None):
+    """
+    写入redis并将key记录在索引集合中，以便按索引批量失效
+    :param key:
+    :param value:
+    :param ex:
+    :param index_key: 索引集合的key，也可以是多个key的list
+    :param index_ex: 索引集合的有效期，不小于其中各key的有效期，默认与ex相同
+    :return:
+    """
+    pipe = redis_client.pipeline()
+    pipe.set(key, value, ex=ex)
+    for _index_key in ([index_key] if isinstance(index_key, basestring) else index_key):
+        pipe.sadd(_index_key, key)
+        pipe.expire(_index_key, index_ex or ex)
+    pipe.execute()
+
+
+def delete_indexed(*index_keys):
+    """
+    删除索引集合中记录的全部key及索引集合本身，并通知所有进程的进程内缓存失效
+    :param index_keys:
+    :return:
+    """
+    if not index_keys:
+        return
+
+    pipe = redis_client.pipeline()
+    for index_key in index_keys:
+        pipe.smembers(index_key)
+    keys = [key for members in pipe.execute() for key in members]
+    redis_client.delete(*(keys + list(index_keys)))
+    if keys:
+        invalidate(*keys)
+
+
+def release_lock(lock):
+    """
+    释放锁（锁已超时失效时忽略）
+    :param lock:
+    :return:
+    """
+    try:
+        lock.release()
+    except LockError:
+        pass
+
+
+def single_flight(key, loader, lock_timeout=10, wait_timeout=3, interval=0.05):
+    """
+    缓存未命中时只允许一个进程回源，其余进程短暂等待回源结果写入缓存
+    :param key:
+    :param loader: 回源函数，负责写入缓存并返回结果
+    :param lock_timeout: 锁的超时时间（秒）
+    :param wait_timeout: 未抢到锁时的最长等待时间（秒）
+    :param interval: 等待时的轮询间隔（秒）
+    :return:
+    """
+    lock = redis_client.lock('%s:lock' % key, timeout=lock_timeout)
+    if lock.acquire(blocking=False):
+        try:
+            return redis_client.get(key) or loader()
+        finally:
+            release_lock(lock)
+
+    deadline = time.time() + wait_timeout
+    while time.time() < deadline:
+        time.sleep(interval)
+        value = redis_client.get(key)
+        if value:
+            return value
+
+
+def _expiring(key, ahead):
+    """
+    缓存是否已失效或剩余有效期不足ahead秒
+    :param key:
+    :param ahead:
+    :return:
+    """
+    ttl = redis_client.ttl(key)
+    return ttl == -2 or 0 <= ttl <= ahead
+
+
+def _refresh_failed(key, backoff, max_backoff):
+    """
+    记录回源失败，按连续失败次数指数退避
+    :param key:
+    :param backoff: 首次失败后的退避时间（秒）
+    :param max_backoff: 最长退避时间（秒）
+    :return:
+    """
+    pipe = redis_client.pipeline()
+    pipe.incr('%s:failures' % key)
+    pipe.expire('%s:failures' % key, max_backoff * 2)
+    failures = pipe.execute()[0]
+    redis_client.set('%s:backoff' % key, failures, ex=min(backoff * 2 ** min(failures - 1, 16), max_backoff))
+
+
+def refresh_ahead(key, loader, ahead, lock_timeout=10, backoff=60, max_backoff=3600):
+    """
+    缓存剩余有效期不足ahead秒时提前回源刷新；其他进程正在刷新时直接跳过；
+    回源失败（返回空值或抛出异常）时按key指数退避，退避期间不再回源
+    :param key:
+    :param loader: 回源函数，负责写入缓存并返回结果
+    :param ahead: 提前刷新的时间（秒）
+    :param lock_timeout: 锁的超时时间（秒）
+    :param backoff: 首次失败后的退避时间（秒）
+    :param max_backoff: 最长退避时间（秒）
+    :return: 是否执行了刷新
+    """
+    if not _expiring(key, ahead) or redis_client.exists('%s:backoff' % key):
+        return False
+
+    lock = redis_client.lock('%s:lock' % key, timeout=lock_timeout)
+    if not lock.acquire(blocking=False):
+        return False
+
+    try:
+        if not _expiring(key, ahead):  # 抢到锁前已被其他进程刷新
+            return False
+        try:
+            result = loader()
+        except Exception:
+            _refresh_failed(key, backoff, max_backoff)
+            raise
+        if result:
+            redis_client.delete('%s:failures' % key, '%s:backoff' % key)
+        else:
+            _refresh_failed(key, backoff, max_backoff)
+        return True
+    finally:
+        release_lock(lock)
+
+
+def dumps_signed(obj):
+    """
+    pickle序列化并在前面加上HMAC-SHA256签名
+    :param obj:
+    :return:
+    """
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    return hmac.new(CACHE_SIGNING_KEY, data, hashlib.sha256).digest() + data
+
+
+def loads_signed(blob):
+    """
+    校验签名后反序列化，签名不符（或未设置签名密钥）时返回None
+    :param blob:
+    :return:
+    """
+    if not (CACHE_SIGNING_KEY and blob and len(blob) > 32):
+        return
+
+    signature, data = blob[:32], blob[32:]
+    if not hmac.compare_digest(signature, hmac.new(CACHE_SIGNING_KEY, data, hashlib.sha256).digest()):
+        return
+    return cPickle.loads(data)
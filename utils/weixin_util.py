@@ -3,17 +3,35 @@
 import os
 import json
 
-import requests
-
-from .redis_util import redis_client
+from .http_util import http_client
+from .redis_util import redis_client, cached_get, cached_set, single_flight, refresh_ahead
 
 
 VERIFY = os.getenv('CA_CERTS_PATH') or False
 
+TOKEN_EXPIRES_MARGIN = 60  # 凭证缓存的过期时间比微信给出的有效期提前1分钟
+TOKEN_REFRESH_AHEAD = 600  # 凭证剩余有效期不足10分钟时由定时任务提前刷新
+TICKET_IN_USE_TTL = 86400  # jsapi_ticket/card_api_ticket最近使用过的标记有效期（秒），期间由定时任务提前刷新
 
-def get_component_access_token(wx):
+MSG_DEDUP_TTL = 60  # 微信消息排重记录的有效期（秒），覆盖微信的3次重试
+MSG_PROCESSING = '__processing__'  # 消息正在处理中
+MSG_DONE = '__done__'  # 消息已处理，没有被动回复
+
+
+def set_token(key, token, expires_in):
     """
-    获取微信第三方平台component_access_token
+    缓存微信接口调用凭证
+    :param key:
+    :param token:
+    :param expires_in: 微信给出的有效期（秒）
+    :return:
+    """
+    cached_set(key, token, ex=max(int(expires_in) - TOKEN_EXPIRES_MARGIN, 1))
+
+
+def _request_component_access_token(wx):
+    """
+    调用微信接口获取component_access_token并缓存
     :param wx: [dict]
     :return:
     """
@@ -22,26 +40,53 @@ def get_component_access_token(wx):
     if not all((app_id, app_secret, verify_ticket)):
         return
 
-    key = 'wx:%s:component_access_token' % app_id
-    access_token = redis_client.get(key)
-    if access_token:
-        return access_token
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/component/api_component_token'
     data = {
         'component_appid': app_id,
         'component_appsecret': app_secret,
         'component_verify_ticket': verify_ticket
     }
-    resp_json = requests.post(wx_url, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    resp_json = http_client.post(wx_url, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
     access_token, expires_in = map(resp_json.get, ('component_access_token', 'expires_in'))
     if not (access_token and expires_in):
         return
 
-    redis_client.set(key, access_token, ex=int(expires_in) - 600)  # 提前10分钟更新component_access_token
+    set_token('wx:%s:component_access_token' % app_id, access_token, expires_in)
     return access_token
 
 
+def get_component_access_token(wx):
+    """
+    获取微信第三方平台component_access_token
+    :param wx: [dict]
+    :return:
+    """
+    app_id = wx.get('app_id')
+    if not app_id:
+        return
+
+    key = 'wx:%s:component_access_token' % app_id
+    access_token = cached_get(key)
+    if access_token or not wx.get('token_sync_refresh', True):
+        return access_token
+
+    return single_flight(key, lambda: _request_component_access_token(wx))  # 并发未命中时只有一个进程调用微信接口
+
+
+def refresh_component_access_token(wx):
+    """
+    在component_access_token过期前提前刷新（由定时任务调用）
+    :param wx: [dict]
+    :return:
+    """
+    app_id = wx.get('app_id')
+    if not app_id:
+        return False
+
+    key = 'wx:%s:component_access_token' % app_id
+    return refresh_ahead(key, lambda: _request_component_access_token(wx), TOKEN_REFRESH_AHEAD)
+
+
 def get_pre_auth_code(wx):
     """
     获取微信第三方平台pre_auth_code
@@ -59,7 +104,7 @@ def get_pre_auth_code(wx):
     data = {
         'component_appid': wx['app_id']
     }
-    resp_json = requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    resp_json = http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
     return resp_json.get('pre_auth_code')
 
 
@@ -82,5 +127,57 @@ def get_authorization_info(wx, auth_code):
         'component_appid': wx['app_id'],
         'authorization_code': auth_code
     }
-    resp_json = requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    resp_json = http_client.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
     return resp_json.get('authorization_info')
+
+
+def message_dedup_key(appid, message):
+    """
+    微信消息的排重key：普通消息按MsgId，事件推送按FromUserName + CreateTime
+    字段只取<xml>的直接子元素（WXMessage保证），且必须是纯文本，避免用户在消息内容中伪造排重key
+    :param appid:
+    :param message: [WXMessage]
+    :return: 无法排重时返回None
+    """
+    msg_id, from_user, create_time = map(message.get, ('MsgId', 'FromUserName', 'CreateTime'))
+    if msg_id:
+        if isinstance(msg_id, basestring) and msg_id.isdigit():
+            return 'wx_msg:%s:%s' % (appid, msg_id)
+        return
+
+    if isinstance(from_user, basestring) and isinstance(create_time, basestring) and create_time.isdigit():
+        return 'wx_msg:%s:%s:%s' % (appid, from_user, create_time)
+
+
+def claim_message(key):
+    """
+    标记消息正在处理；微信重试的消息（包括仍在处理中的）不再处理
+    :param key: [str or None]
+    :return: (是否需要处理, 已保存的被动回复)
+    """
+    if key is None or redis_client.set(key, MSG_PROCESSING, ex=MSG_DEDUP_TTL, nx=True):
+        return True, None
+
+    reply = redis_client.get(key)
+    return False, None if reply in (MSG_PROCESSING, MSG_DONE) else reply
+
+
+def finish_message(key, reply=None):
+    """
+    消息处理完成，保存被动回复供重试的消息直接返回
+    :param key: [str or None]
+    :param reply: [str or None]
+    :return:
+    """
+    if key is not None:
+        redis_client.set(key, reply or MSG_DONE, ex=MSG_DEDUP_TTL)
+
+
+def release_message(key):
+    """
+    消息处理失败，清除处理标记以便微信重试时重新处理
+    :param key: [str or None]
+    :return:
+    """
+    if key is not None:
+        redis_client.delete(key)